@@ -0,0 +1,275 @@
+"""Benchmarks of the poll -> validate -> parse -> send pipeline.
+
+Runs the bot functions against a local fake Practicum server and a fake
+telegram bot and stores the results as JSON:
+
+    python benchmarks/bench_pipeline.py --output results.json
+    python benchmarks/bench_pipeline.py --compare old.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import homework  # noqa: E402
+
+STATUSES = tuple(homework.HOMEWORK_VERDICTS)
+
+
+def make_payload(size):
+    """Build a homework_statuses body with the given number of homeworks."""
+    return json.dumps({
+        'homeworks': [
+            {
+                'id': index,
+                'homework_name': f'user__project_{index}.zip',
+                'status': STATUSES[index % len(STATUSES)],
+                'reviewer_comment': 'Всё нравится',
+                'date_updated': '2020-02-13T14:40:57Z',
+                'lesson_name': f'Спринт {index}'
+            }
+            for index in range(size)
+        ],
+        'current_date': 1581604970
+    }).encode()
+
+
+class FakePracticumHandler(BaseHTTPRequestHandler):
+    """Serve the same payload to every request."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer with the configured payload."""
+        body = self.server.payload
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the benchmark output clean."""
+
+
+class FakePracticumServer:
+    """Local homework_statuses endpoint running in a thread."""
+
+    def __init__(self):
+        """Bind to a free local port."""
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakePracticumHandler
+        )
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.server.payload = make_payload(0)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def __enter__(self):
+        """Start serving."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeTelegramBot:
+    """Count messages instead of sending them."""
+
+    def __init__(self):
+        """Start with no messages."""
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        """Record a sent message."""
+        with self.lock:
+            self.sent += 1
+
+
+def summarize(samples):
+    """Describe latency samples in milliseconds."""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return dict(
+        count=len(ordered),
+        mean_ms=total / len(ordered) * 1000,
+        p50_ms=ordered[len(ordered) // 2] * 1000,
+        p95_ms=ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        max_ms=ordered[-1] * 1000,
+        per_second=len(ordered) / total if total else None
+    )
+
+
+def timed(samples, function, *args):
+    """Call the function and record its duration."""
+    start = time.perf_counter()
+    result = function(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def bench_stages(server, size, repeat):
+    """Measure every pipeline stage on a response of the given size."""
+    server.server.payload = make_payload(size)
+    bot = FakeTelegramBot()
+    stages = dict(get_api_answer=[], check_response=[], parse_status=[],
+                  send_message=[])
+    for _ in range(repeat):
+        response = timed(stages['get_api_answer'], homework.get_api_answer, 0)
+        timed(stages['check_response'], homework.check_response, response)
+        for item in response['homeworks']:
+            message = timed(
+                stages['parse_status'], homework.parse_status, item
+            )
+        if response['homeworks']:
+            timed(stages['send_message'], homework.send_message, bot, message)
+    return {
+        name: summarize(samples) for name, samples in stages.items() if samples
+    }
+
+
+def bench_cycles(server, tenants_count, size, repeat, workers):
+    """Measure full polling cycles for many tenants."""
+    server.server.payload = make_payload(size)
+    bot = FakeTelegramBot()
+    outbox = homework.Outbox(
+        size=tenants_count * (size + 1), global_rate=10 ** 9,
+        chat_rate=10 ** 9, chat_burst=size + 1
+    )
+    tenants = [
+        homework.Tenant(
+            index,
+            partial(
+                homework.request_api_answer,
+                homework.make_headers(f'token-{index}')
+            ),
+            partial(
+                outbox.put, index,
+                partial(homework.send_chat_message, bot, index)
+            )
+        )
+        for index in range(tenants_count)
+    ]
+    first, steady = [], []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for cycle in range(repeat + 1):
+            samples = first if cycle == 0 else steady
+            start = time.perf_counter()
+            homework.poll_tenants(tenants, executor)
+            outbox.flush()
+            samples.append(time.perf_counter() - start)
+    result = dict(
+        first_cycle=summarize(first), sent=bot.sent,
+        tenants_per_second=tenants_count / first[0]
+    )
+    if steady:
+        result['steady_cycle'] = summarize(steady)
+    return result
+
+
+def git_commit():
+    """Return the commit the benchmark runs against, if known."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """Run all benchmark scenarios."""
+    homework.HTTP_KEEP_ALIVE = options.keep_alive
+    results = dict(
+        commit=git_commit(),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        keep_alive=options.keep_alive,
+        stages={},
+        cycles={}
+    )
+    with FakePracticumServer() as server:
+        homework.ENDPOINT = server.url
+        for size in options.homeworks:
+            results['stages'][str(size)] = bench_stages(
+                server, size, options.repeat
+            )
+        for tenants_count in options.tenants:
+            results['cycles'][str(tenants_count)] = bench_cycles(
+                server, tenants_count, options.cycle_homeworks,
+                options.cycles, options.workers
+            )
+    return results
+
+
+def flatten(results, prefix=''):
+    """Turn nested results into metric name -> value pairs."""
+    metrics = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(old_path, new_path):
+    """Print the relative change of every metric between two runs."""
+    with open(old_path, encoding='utf-8') as file:
+        old = flatten(json.load(file))
+    with open(new_path, encoding='utf-8') as file:
+        new = flatten(json.load(file))
+    for name in sorted(old.keys() & new.keys()):
+        if old[name]:
+            change = (new[name] - old[name]) / old[name] * 100
+            print(f'{name}: {old[name]:.3f} -> {new[name]:.3f} '
+                  f'({change:+.1f}%)')
+
+
+def numbers(value):
+    """Parse a comma separated list of integers."""
+    return [int(number) for number in value.split(',')]
+
+
+def parse_args():
+    """Read the command line options."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tenants', type=numbers,
+                        default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--homeworks', type=numbers,
+                        default=[1, 100, 1000, 10000])
+    parser.add_argument('--cycle-homeworks', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=homework.POLL_WORKERS)
+    parser.add_argument('--keep-alive', action='store_true')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    if options.compare:
+        compare(*options.compare)
+    else:
+        results = run(options)
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(json.dumps(results, ensure_ascii=False, indent=2))
@@ -0,0 +1,351 @@
+"""Deterministic simulation of the bot on a virtual clock.
+
+Replays scripted homework status timelines for many tenants through the
+bot's scheduler, fetchers and outbox against a fake Practicum API and a
+fake telegram bot. Nothing sleeps and nothing touches the network, so days
+of activity take seconds and the same seed always gives the same report:
+
+    python benchmarks/simulate.py --tenants 1000 --days 3 --policy adaptive
+"""
+import argparse
+import bisect
+import json
+import os
+import random
+import sys
+import time
+from functools import partial
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import homework  # noqa: E402
+
+DAY = 24 * 60 * 60
+
+
+class VirtualClock:
+    """Clock that only moves when the simulation advances it."""
+
+    def __init__(self, now=0):
+        """Start at the given time."""
+        self.now = now
+
+    def __call__(self):
+        """Return the current virtual time."""
+        return self.now
+
+
+class InlineExecutor:
+    """Executor that runs every call in the calling thread, in order."""
+
+    def map(self, function, *iterables):
+        """Call the function for every item right away."""
+        return list(map(function, *iterables))
+
+
+class FakeResponse:
+    """The part of requests.Response the bot uses."""
+
+    def __init__(self, body):
+        """Answer 200 with the given body."""
+        self.status_code = 200
+        self.headers = {}
+        self.content = body
+
+    def json(self):
+        """Decode the body."""
+        return json.loads(self.content)
+
+
+def make_timeline(rng, name_prefix, homeworks, end, review, fix):
+    """Script the status changes of a student's homeworks.
+
+    Every homework is sent for review at a random time, reviewed after
+    an exponential delay and, when rejected, sent again after a fix.
+    """
+    events = []
+    for index in range(homeworks):
+        name = f'{name_prefix}_project_{index}.zip'
+        moment = rng.randrange(end)
+        while moment < end:
+            events.append((moment, index, name, 'reviewing'))
+            moment += 1 + int(rng.expovariate(1 / review))
+            if moment >= end:
+                break
+            status = 'approved' if rng.random() < 0.6 else 'rejected'
+            events.append((moment, index, name, status))
+            if status == 'approved':
+                break
+            moment += 1 + int(rng.expovariate(1 / fix))
+    events.sort()
+    return events
+
+
+class FakePracticum:
+    """homework_statuses endpoint that replays scripted timelines."""
+
+    def __init__(self, clock, timelines):
+        """Serve the timelines of every token."""
+        self.clock = clock
+        self.timelines = timelines
+        self.moments = {
+            token: [event[0] for event in events]
+            for token, events in timelines.items()
+        }
+        self.calls = dict.fromkeys(timelines, 0)
+
+    def get(self, url, headers, params, **kwargs):
+        """Return the homeworks updated between from_date and now."""
+        token = headers['Authorization'].split()[-1]
+        self.calls[token] += 1
+        now = int(self.clock())
+        moments = self.moments[token]
+        events = self.timelines[token][
+            bisect.bisect_left(moments, params['from_date']):
+            bisect.bisect_right(moments, now)
+        ]
+        if not events:
+            return FakeResponse(
+                b'{"homeworks": [], "current_date": %d}' % now
+            )
+        latest = {}
+        for moment, index, name, status in events:
+            latest[index] = dict(
+                id=index, homework_name=name, status=status,
+                date_updated=moment
+            )
+        homeworks = sorted(
+            latest.values(), key=lambda item: item['date_updated'],
+            reverse=True
+        )
+        return FakeResponse(json.dumps(
+            {'homeworks': homeworks, 'current_date': now}
+        ).encode())
+
+
+class DiscardStateStore:
+    """State store that keeps nothing, the simulation never restarts."""
+
+    def load(self, key):
+        """Return no saved state."""
+
+    def save_many(self, states):
+        """Drop the states without taking snapshots."""
+
+
+class FakeTelegramBot:
+    """Record sent messages with their virtual send time."""
+
+    def __init__(self, clock):
+        """Start with no messages."""
+        self.clock = clock
+        self.sent = {}
+
+    def send_message(self, chat_id, text):
+        """Record a message."""
+        self.sent.setdefault(chat_id, []).append((self.clock(), text))
+
+
+def make_policy(options, rng):
+    """Create the polling policy under test."""
+    if options.policy == 'adaptive':
+        return homework.AdaptivePollPolicy(rng=rng)
+    return homework.make_poll_policy(options.policy, options.period)
+
+
+def make_tenants(options, tokens, clock, outbox, bot):
+    """Subscribe one chat per tenant to the scripted tokens."""
+    cache = homework.ResponseCache() if options.response_cache else None
+    flights = homework.SingleFlight(clock=clock) if (
+        options.single_flight
+    ) else None
+    tenants = []
+    for index in range(options.tenants):
+        token = tokens[index % len(tokens)]
+        key = homework.tenant_key(token, index)
+        tenants.append(homework.Tenant(
+            key,
+            homework.make_fetcher(
+                homework.make_headers(token), cache, flights, key
+            ),
+            partial(homework.fan_out, outbox, [
+                (index, partial(homework.send_chat_message, bot, index))
+            ]),
+            homework.token_digest(token)
+        ))
+    return tenants
+
+
+def run_until(end, clock, scheduler, tenants, outbox, store):
+    """Drive polling cycles and outbox deliveries up to the end time."""
+    executor = InlineExecutor()
+    cycles = 0
+    while clock.now < end:
+        homework.poll_due_tenants(
+            scheduler, tenants, executor, None, outbox, store
+        )
+        cycles += 1
+        wake = clock.now + max(1, scheduler.delay())
+        pending = outbox.next_delay()
+        while pending is not None and clock.now + pending < wake:
+            clock.now += max(pending, 0.001)
+            outbox.flush()
+            pending = outbox.next_delay()
+        clock.now = wake
+    return cycles
+
+
+def detection_latencies(timeline, sent):
+    """Match scripted status changes to the first message about them.
+
+    A change counts as missed when no message about it was sent before
+    the next change of the same homework.
+    """
+    latencies = []
+    missed = 0
+    superseded = {}
+    for position in range(len(timeline) - 1, -1, -1):
+        moment, index, name, status = timeline[position]
+        until = superseded.get(index, float('inf'))
+        superseded[index] = moment
+        message = homework.Homework(
+            index, name, homework.HomeworkStatus(status)
+        ).message
+        latency = next(
+            (
+                sent_at - moment for sent_at, text in sent
+                if moment <= sent_at < until and message in text
+            ),
+            None
+        )
+        if latency is None:
+            missed += 1
+        else:
+            latencies.append(latency)
+    return latencies, missed
+
+
+def summarize(values):
+    """Describe a list of numbers."""
+    if not values:
+        return dict(count=0)
+    ordered = sorted(values)
+    return dict(
+        count=len(ordered),
+        mean=sum(ordered) / len(ordered),
+        p50=ordered[len(ordered) // 2],
+        p95=ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        max=ordered[-1]
+    )
+
+
+def simulate(options):
+    """Run the scenario and return the report."""
+    rng = random.Random(options.seed)
+    clock = VirtualClock()
+    end = int(options.days * DAY)
+    tokens = [f'token-{index}' for index in range(
+        options.tokens or options.tenants
+    )]
+    timelines = {
+        token: make_timeline(
+            rng, token, options.homeworks, end, options.review, options.fix
+        )
+        for token in tokens
+    }
+    api = FakePracticum(clock, timelines)
+    bot = FakeTelegramBot(clock)
+    outbox = homework.Outbox(size=10 ** 9, workers=1, clock=clock)
+    with mock.patch.multiple(
+        homework, http_get=api.get, STREAM_HOMEWORKS=False,
+        PROCESS_POOL_WORKERS=0, CYCLE_DEADLINE=0,
+        API_BREAKER=homework.CircuitBreaker('practicum', clock=clock),
+        TELEGRAM_BREAKER=homework.CircuitBreaker('telegram', clock=clock)
+    ):
+        tenants = make_tenants(options, tokens, clock, outbox, bot)
+        scheduler = homework.PollScheduler(make_policy(options, rng), clock)
+        started = time.perf_counter()
+        cycles = run_until(
+            end, clock, scheduler, tenants, outbox, DiscardStateStore()
+        )
+    wall_seconds = time.perf_counter() - started
+
+    latencies, missed, per_tenant = [], 0, []
+    for index in range(options.tenants):
+        token = tokens[index % len(tokens)]
+        sent = bot.sent.get(index, [])
+        tenant_latencies, tenant_missed = detection_latencies(
+            timelines[token], sent
+        )
+        latencies.extend(tenant_latencies)
+        missed += tenant_missed
+        per_tenant.append(dict(
+            tenant=index, sends=len(sent), missed=tenant_missed,
+            detection_latency=summarize(tenant_latencies)
+        ))
+    report = dict(
+        seed=options.seed,
+        tenants=options.tenants,
+        tokens=len(tokens),
+        days=options.days,
+        policy=options.policy,
+        response_cache=options.response_cache,
+        single_flight=options.single_flight,
+        wall_seconds=wall_seconds,
+        cycles=cycles,
+        api_calls=dict(
+            total=sum(api.calls.values()),
+            per_token=summarize(list(api.calls.values()))
+        ),
+        sends=dict(
+            total=sum(item['sends'] for item in per_tenant),
+            per_tenant=summarize([item['sends'] for item in per_tenant])
+        ),
+        events=dict(
+            total=sum(len(timelines[token]) for token in (
+                tokens[index % len(tokens)]
+                for index in range(options.tenants)
+            )),
+            missed=missed
+        ),
+        detection_latency=summarize(latencies)
+    )
+    if options.per_tenant:
+        report['per_tenant'] = per_tenant
+    return report
+
+
+def parse_args():
+    """Read the command line options."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tenants', type=int, default=1000)
+    parser.add_argument('--tokens', type=int, default=0,
+                        help='distinct tokens shared by the tenants '
+                             '(default: one per tenant)')
+    parser.add_argument('--days', type=float, default=3)
+    parser.add_argument('--homeworks', type=int, default=3)
+    parser.add_argument('--review', type=float, default=DAY / 2,
+                        help='mean review time in seconds')
+    parser.add_argument('--fix', type=float, default=DAY,
+                        help='mean time to fix a rejected homework')
+    parser.add_argument('--policy', choices=list(homework.POLL_POLICIES),
+                        default='fixed')
+    parser.add_argument('--period', type=int, default=homework.RETRY_PERIOD)
+    parser.add_argument('--response-cache', action='store_true')
+    parser.add_argument('--single-flight', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--per-tenant', action='store_true')
+    parser.add_argument('--output')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    report = simulate(options)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+    print(text)
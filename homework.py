@@ -1,12 +1,58 @@
+import argparse
+import bisect
+import codecs
+import copy
+import hashlib
+import importlib
+import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
+import sys
+import threading
 import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+from contextlib import nullcontext
+from enum import Enum
+from functools import partial
 from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-import requests
-import telegram
 from dotenv import load_dotenv
 
+
+class LazyModule:
+    """Module imported on the first attribute access."""
+
+    def __init__(self, name):
+        """Remember the module name without importing it."""
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        """Import the module and return its attribute."""
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """Import the module once and return it."""
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+
+requests = LazyModule('requests')
+telegram = LazyModule('telegram')
+
 load_dotenv()
 
 
@@ -14,13 +60,96 @@ PRACTICUM_TOKEN = os.getenv('PRACTICUM_TOKEN')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 
+SUBSCRIPTIONS_FILE = os.getenv('SUBSCRIPTIONS_FILE')
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', 16))
+HTTP_KEEP_ALIVE = os.getenv('HTTP_KEEP_ALIVE', 'false').lower() == 'true'
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', POLL_WORKERS))
+HTTP_POOL_BLOCK = os.getenv('HTTP_POOL_BLOCK', 'false').lower() == 'true'
+STATE_DB = os.getenv('STATE_DB', 'homework_state.sqlite3')
+POLL_POLICY = os.getenv('POLL_POLICY', 'fixed')
+POLL_MIN_PERIOD = int(os.getenv('POLL_MIN_PERIOD', 60))
+POLL_MAX_PERIOD = int(os.getenv('POLL_MAX_PERIOD', 3600))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', 2))
+POLL_JITTER = float(os.getenv('POLL_JITTER', 0.1))
+OUTBOX_SIZE = int(os.getenv('OUTBOX_SIZE', 10000))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 5))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 8))
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_HOMEWORKS = os.getenv('STREAM_HOMEWORKS', 'false').lower() == 'true'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 16384))
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'false').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))
+SINGLE_FLIGHT_TTL = float(os.getenv('SINGLE_FLIGHT_TTL', 5))
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', 5))
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', 30))
+CYCLE_DEADLINE = float(os.getenv('CYCLE_DEADLINE', 300))
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', 0.95))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', POLL_WORKERS))
+HEDGE_WINDOW = 200
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 0))
+WEBHOOK_RECONCILE_PERIOD = int(os.getenv('WEBHOOK_RECONCILE_PERIOD', 3600))
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
+COORDINATOR_DB = os.getenv('COORDINATOR_DB')
+WORKER_ID = os.getenv('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+WORKER_LEASE = float(os.getenv('WORKER_LEASE', 90))
+HASH_RING_REPLICAS = 100
+PROCESS_POOL_WORKERS = int(os.getenv('PROCESS_POOL_WORKERS', 0))
+PROCESS_BATCH_SIZE = int(os.getenv('PROCESS_BATCH_SIZE', 64))
+MESSAGE_LOCALE = os.getenv('MESSAGE_LOCALE', 'ru')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_RECOVERY = float(os.getenv('BREAKER_RECOVERY', 30))
+ERROR_INDEX_SIZE = int(os.getenv('ERROR_INDEX_SIZE', 32))
+ERROR_TTL = float(os.getenv('ERROR_TTL', 6 * 3600))
+ERROR_SUMMARY_PERIOD = float(os.getenv('ERROR_SUMMARY_PERIOD', 3600))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 20))
+SHUTDOWN_GRACE = 1
+SHUTDOWN_CHECK = 1
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_FILE = os.getenv('LOG_FILE', f'{__name__}.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 0))
+LOG_ROTATE_INTERVAL = int(os.getenv('LOG_ROTATE_INTERVAL', 0))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', 60))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 5))
+LOG_SAMPLE_KEYS = 1024
+LOG_TEXT_FORMAT = '%(asctime)s, %(levelname)s, %(message)s'
+
 VARIABLES = ('PRACTICUM_TOKEN', 'TELEGRAM_TOKEN', 'TELEGRAM_CHAT_ID')
+SUBSCRIPTIONS_VARIABLES = ('TELEGRAM_TOKEN',)
 
 RETRY_PERIOD = 600
 ENDPOINT = 'https://practicum.yandex.ru/api/user_api/homework_statuses/'
 HEADERS = {'Authorization': f'OAuth {PRACTICUM_TOKEN}'}
 
 
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+VOLATILE_FIELDS = re.compile(rb'"current_date"\s*:\s*\d+')
+NOT_MODIFIED = object()
+RawResponse = namedtuple('RawResponse', ('body', 'parameters'))
+DecodedResponse = namedtuple('DecodedResponse', ('homeworks', 'current_date'))
+CachedAnswer = namedtuple('CachedAnswer', ('response', 'commit'))
+
+STATUS_INDEX = 'id'
+
+POLL_CHANGED = 'changed'
+POLL_IDLE = 'idle'
+POLL_ERROR = 'error'
+
 HOMEWORK_VERDICTS = {
     'approved': 'Работа проверена: ревьюеру всё понравилось. Ура!',
     'reviewing': 'Работа взята на проверку ревьюером.',
@@ -64,6 +193,19 @@ STATUS_VALUE_ERROR = (
 PARSE_STATUS_RESULT = (
     'Изменился статус проверки работы "{homework_name}". {verdict}'
 )
+HOMEWORK_VERDICTS_EN = {
+    'approved': 'The review is done: the reviewer liked everything. Hooray!',
+    'reviewing': 'The work has been taken for review.',
+    'rejected': 'The review is done: the reviewer has some remarks.'
+}
+PARSE_STATUS_RESULT_EN = (
+    'The review status of "{homework_name}" has changed. {verdict}'
+)
+LOCALES = {
+    'ru': (PARSE_STATUS_RESULT, HOMEWORK_VERDICTS),
+    'en': (PARSE_STATUS_RESULT_EN, HOMEWORK_VERDICTS_EN)
+}
+LOCALE_ERROR = 'Неизвестная локаль {name}, ожидается одна из: {names}.'
 MAIN_MESSAGE_ERROR = (
     'Бот не смог отправить сообщение. Возникла ошибка: {error}'
 )
@@ -71,11 +213,60 @@ MAIN_API_ERROR = (
     'Не получилось сформировать ответ API. '
     'Полученная ошибка: {error}.'
 )
+MAIN_API_STILL_FAILING = (
+    'Ошибка API повторяется (уже {count} раз). '
+    'Последняя ошибка: {error}.'
+)
+TENANTS_LOADED = 'Загружено подписок: {count}.'
+PROCESS_POOL_IGNORED = (
+    'В режиме PROCESS_POOL_WORKERS не поддерживаются и выключены: {names}.'
+)
+POLL_POLICY_ERROR = (
+    'Неизвестная политика опроса {name}, ожидается одна из: {names}.'
+)
+OUTBOX_FULL = 'Очередь отправки переполнена: {size} сообщений.'
+OUTBOX_DROPPED = (
+    'Сообщения не отправлены после {attempts} попыток и удалены '
+    'из очереди: {count}.'
+)
+METRICS_STARTED = 'Метрики доступны на http://{host}:{port}/metrics'
+WEBHOOK_STARTED = 'Приём статусов работ на http://{host}:{port}/homeworks'
+WEBHOOK_ERROR = 'Не удалось обработать присланные статусы работ: {error}'
+WEBHOOK_LENGTH_ERROR = 'Некорректный Content-Length: {length}'
+WORKER_HEARTBEAT_ERROR = 'Не удалось продлить аренду воркера: {error}'
+WORKER_LEASE_LOST = (
+    'Аренда воркера {worker} истекла, подписки не опрашиваются '
+    'до её продления.'
+)
+SHARD_CHANGED = 'Воркер {worker} обслуживает подписок: {count} из {total}.'
+STATE_SAVE_ERROR = 'Не удалось сохранить состояние бота: {error}'
+CONNECTION_STATS = (
+    'Соединения с API: новых {new}, повторно использованных {reused}.'
+)
+CIRCUIT_OPENED = (
+    'Сервис {name} недоступен, запросы приостановлены на {seconds} с.'
+)
+CIRCUIT_CLOSED = 'Сервис {name} снова доступен.'
+CIRCUIT_OPEN_ERROR = 'Запросы к сервису {name} приостановлены после ошибок.'
+LOG_SUPPRESSED = '{message} (пропущено повторов: {count})'
+SHUTDOWN_STARTED = (
+    'Получен сигнал {signal}, бот завершает работу '
+    '(не дольше {seconds} с).'
+)
+SHUTDOWN_UNSENT = 'При остановке не отправлено сообщений: {count}.'
+SHUTDOWN_FORCED = 'Бот не успел завершить работу и остановлен принудительно.'
+STARTUP_IMPORT = 'Импорт {name}: {seconds:.3f} с.'
+BOT_CREATED = 'Бот telegram создан за {seconds:.3f} с.'
+CYCLE_DEADLINE_EXCEEDED = (
+    'За {seconds:.1f} с не дождались ответа API для подписок: {count}. '
+    'Их запросы завершатся в фоне.'
+)
 
 
 def check_tokens():
     """Check that the required variables have been received."""
-    empty_variables = [name for name in VARIABLES if not globals()[name]]
+    names = SUBSCRIPTIONS_VARIABLES if SUBSCRIPTIONS_FILE else VARIABLES
+    empty_variables = [name for name in names if not globals()[name]]
     if empty_variables:
         logging.critical(
             CHECK_TOKENS_CRITICAL_MESSAGE.format(names=empty_variables)
@@ -85,36 +276,1391 @@ def check_tokens():
         )
 
 
+class HomeworkStatus(str, Enum):
+    """Homework status, one of the HOMEWORK_VERDICTS keys."""
+
+    APPROVED = 'approved'
+    REVIEWING = 'reviewing'
+    REJECTED = 'rejected'
+
+
+class Homework:
+    """Homework from an API response, validated once on construction."""
+
+    __slots__ = ('id', 'name', 'status')
+
+    def __init__(self, id, name, status):
+        """Keep the fields the bot uses."""
+        self.id = id
+        self.name = name
+        self.status = status
+
+    def __repr__(self):
+        """Show the homework fields."""
+        return f'Homework({self.id!r}, {self.name!r}, {self.status.value!r})'
+
+    @classmethod
+    def from_dict(cls, homework):
+        """Build a homework from the API dict, checking its fields."""
+        if 'homework_name' not in homework:
+            raise KeyError(HOMEWORK_NAME_KEY_ERROR)
+        status = homework['status']
+        try:
+            status = HomeworkStatus(status)
+        except ValueError:
+            raise ValueError(STATUS_VALUE_ERROR.format(status=status))
+        return cls(
+            homework.get('id'), sys.intern(homework['homework_name']), status
+        )
+
+    @property
+    def key(self):
+        """Return the key of the homework in the status index."""
+        return self.name if self.id is None else str(self.id)
+
+    @property
+    def message(self):
+        """Return the telegram message about the homework status."""
+        return MESSAGES.render(self)
+
+
+class MessageTemplates:
+    """Status messages of one locale, prepared once per verdict."""
+
+    MARKER = '\0'
+
+    def __init__(self, locale='ru'):
+        """Fill the verdicts into the locale template."""
+        if locale not in LOCALES:
+            raise ValueError(LOCALE_ERROR.format(
+                name=locale, names=list(LOCALES)
+            ))
+        template, verdicts = LOCALES[locale]
+        self.parts = {}
+        for status in HomeworkStatus:
+            prefix, _, suffix = template.format(
+                homework_name=self.MARKER, verdict=verdicts[status.value]
+            ).partition(self.MARKER)
+            self.parts[status] = (sys.intern(prefix), sys.intern(suffix))
+
+    def render(self, homework):
+        """Return the message about the homework status."""
+        prefix, suffix = self.parts[homework.status]
+        return prefix + homework.name + suffix
+
+
+MESSAGES = MessageTemplates(MESSAGE_LOCALE)
+
+
+class Tenant:
+    """Subscription of a telegram chat to a Practicum token."""
+
+    def __init__(self, key, fetch, notify, digest=None, alert=None):
+        """Bind the tenant to its fetch and notify callables.
+
+        Errors go to alert, which defaults to notify: their text includes
+        the request headers and must only reach the owner of the token.
+        """
+        self.key = key
+        self.fetch = fetch
+        self.notify = notify
+        self.alert = notify if alert is None else alert
+        self.digest = digest
+        self.timestamp = 0
+        self.statuses = {}
+        self.last_error = ''
+        self.errors = None
+        self.polling = None
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """Return the tenant state that survives restarts."""
+        with self.lock:
+            return dict(
+                timestamp=self.timestamp,
+                statuses=dict(self.statuses),
+                last_error=self.last_error,
+                index=STATUS_INDEX
+            )
+
+    def restore(self, state):
+        """Continue from a previously saved state."""
+        if state:
+            self.timestamp = state['timestamp']
+            if state.get('index') == STATUS_INDEX:
+                self.statuses = {
+                    key: HomeworkStatus(status)
+                    for key, status in state['statuses'].items()
+                }
+            self.last_error = state['last_error']
+
+
+class MemoryStateStore:
+    """Tenant states kept in memory, lost on restart."""
+
+    def __init__(self):
+        """Start with no saved states."""
+        self.states = {}
+
+    def load(self, key):
+        """Return the saved state of a tenant or None."""
+        return self.states.get(key)
+
+    def save_many(self, states):
+        """Save the states of several tenants."""
+        for key, state in states:
+            self.states[key] = json.loads(json.dumps(state))
+
+
+class SqliteStateStore:
+    """Tenant states kept in an SQLite database."""
+
+    def __init__(self, path):
+        """Open the database and create the state table."""
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS tenant_state '
+                '(key TEXT PRIMARY KEY, state TEXT NOT NULL)'
+            )
+
+    def load(self, key):
+        """Return the saved state of a tenant or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT state FROM tenant_state WHERE key = ?', (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, states):
+        """Save the states of several tenants in one transaction."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO tenant_state (key, state) '
+                'VALUES (?, ?)',
+                [(key, json.dumps(state)) for key, state in states]
+            )
+
+
+def make_state_store(path):
+    """Choose the state backend for the given database path."""
+    if path in ('', ':memory:'):
+        return MemoryStateStore()
+    return SqliteStateStore(path)
+
+
+class Metric:
+    """Prometheus counter, gauge or histogram with optional labels."""
+
+    def __init__(self, name, description, kind, buckets=()):
+        """Start with no observed values."""
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Increase a counter."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Set a gauge."""
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        """Record a histogram observation."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(
+                key, [0] * (len(self.buckets) + 2)
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} {self.kind}'
+        ]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+                continue
+            for bound, count in zip(self.buckets, value[:-2]):
+                labels = format_labels(key + (('le', bound),))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            lines.append(f'{self.name}_bucket'
+                         f'{format_labels(key + (("le", "+Inf"),))} '
+                         f'{value[-1]}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {value[-2]}')
+            lines.append(f'{self.name}_count{format_labels(key)} {value[-1]}')
+        return lines
+
+
+def format_labels(key):
+    """Format metric labels as {name="value",...}."""
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+
+class MetricsRegistry:
+    """Collection of the bot metrics."""
+
+    def __init__(self):
+        """Start with no metrics."""
+        self.metrics = []
+
+    def add(self, name, description, kind='counter', buckets=()):
+        """Register a new metric."""
+        metric = Metric(name, description, kind, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+API_LATENCY = METRICS.add(
+    'homework_api_request_seconds', 'Practicum API request latency.',
+    'histogram', LATENCY_BUCKETS
+)
+API_RESPONSES = METRICS.add(
+    'homework_api_responses_total',
+    'Practicum API responses by status code.'
+)
+API_JSON_ERRORS = METRICS.add(
+    'homework_api_json_errors_total',
+    'Practicum API responses with an error or code key.'
+)
+SEND_LATENCY = METRICS.add(
+    'telegram_send_seconds', 'Telegram send latency.',
+    'histogram', LATENCY_BUCKETS
+)
+SEND_FAILURES = METRICS.add(
+    'telegram_send_failures_total', 'Failed telegram sends.'
+)
+CYCLE_DURATION = METRICS.add(
+    'bot_cycle_seconds', 'Duration of a polling cycle.',
+    'histogram', LATENCY_BUCKETS
+)
+SLEEP_DRIFT = METRICS.add(
+    'bot_sleep_drift_seconds', 'Oversleep of the main loop.',
+    'histogram', LATENCY_BUCKETS
+)
+CACHE_HITS = METRICS.add(
+    'homework_api_cache_hits_total', 'Polls answered by the response cache.'
+)
+OUTBOX_DEPTH = METRICS.add(
+    'bot_outbox_pending', 'Messages waiting in the outbox.', 'gauge'
+)
+API_HEDGES = METRICS.add(
+    'homework_api_hedged_requests_total',
+    'Practicum API requests sent again after a slow first attempt.'
+)
+CIRCUIT_STATE = METRICS.add(
+    'bot_circuit_state',
+    'Circuit breaker state: 0 closed, 1 half-open, 2 open.', 'gauge'
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the bot metrics on /metrics."""
+
+    def do_GET(self):
+        """Answer a metrics scrape."""
+        if self.path != '/metrics':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = METRICS.render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Do not log every scrape."""
+
+
+class CircuitOpenError(ConnectionError):
+    """A call skipped because its dependency is known to be down."""
+
+    def __init__(self, name, retry_after):
+        """Describe the skipped dependency."""
+        super().__init__(CIRCUIT_OPEN_ERROR.format(name=name))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed, open and half-open states of a dependency shared by tenants.
+
+    After threshold failures in a row the circuit opens and calls fail fast.
+    Once the recovery time passes a single probe call is let through:
+    its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD,
+                 recovery=BREAKER_RECOVERY, clock=time.monotonic):
+        """Start closed."""
+        self.name = name
+        self.threshold = threshold
+        self.recovery = recovery
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_at = None
+        self.lock = threading.Lock()
+        CIRCUIT_STATE.set(0, dependency=name)
+
+    def set_state(self, state):
+        """Switch the state and export it."""
+        self.state = state
+        CIRCUIT_STATE.set(self.STATES[state], dependency=self.name)
+
+    def before(self):
+        """Raise CircuitOpenError unless a call may go through now."""
+        if not self.threshold:
+            return
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            now = self.clock()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.recovery:
+                    raise CircuitOpenError(
+                        self.name, self.opened_at + self.recovery - now
+                    )
+                self.set_state(self.HALF_OPEN)
+                self.probe_at = None
+            if self.probe_at is not None and (
+                now - self.probe_at < self.recovery
+            ):
+                raise CircuitOpenError(self.name, self.recovery)
+            self.probe_at = now
+
+    def record(self, success):
+        """Count the outcome of a call."""
+        if not self.threshold:
+            return
+        with self.lock:
+            if success:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self.set_state(self.CLOSED)
+                    logging.info(CIRCUIT_CLOSED.format(name=self.name))
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.threshold
+            ):
+                self.set_state(self.OPEN)
+                self.opened_at = self.clock()
+                logging.error(CIRCUIT_OPENED.format(
+                    name=self.name, seconds=self.recovery
+                ))
+
+
+API_BREAKER = CircuitBreaker('practicum')
+TELEGRAM_BREAKER = CircuitBreaker('telegram')
+
+
+def start_metrics_server(host, port):
+    """Serve the metrics endpoint from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(METRICS_STARTED.format(host=host, port=server.server_port))
+    return server
+
+
+class KeepAliveSession:
+    """Lazily created HTTP session with a persistent connection pool."""
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block):
+        """Remember the pool limits until the session is first used."""
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.session = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Return the session, creating it on first use."""
+        with self.lock:
+            if self.session is None:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                    pool_block=self.pool_block
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.session = session
+            return self.session
+
+    def get(self, **kwargs):
+        """Send a GET request through the pooled connections."""
+        return self.open().get(**kwargs)
+
+    def stats(self):
+        """Count new and reused connections across all host pools."""
+        stats = dict(new=0, reused=0)
+        if self.session is None:
+            return stats
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['new'] += pool.num_connections
+                stats['reused'] += pool.num_requests - pool.num_connections
+        return stats
+
+
+HTTP_SESSION = KeepAliveSession(
+    HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_POOL_BLOCK
+)
+
+
+def send_get(**kwargs):
+    """Send a GET request, reusing connections when keep-alive is on."""
+    if HTTP_KEEP_ALIVE:
+        return HTTP_SESSION.get(**kwargs)
+    return requests.get(**kwargs)
+
+
+class LatencyWindow:
+    """Latencies of the recent successful requests."""
+
+    def __init__(self, size=HEDGE_WINDOW, minimum=HEDGE_MIN_SAMPLES):
+        """Keep up to size latencies."""
+        self.samples = deque(maxlen=size)
+        self.minimum = minimum
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        """Record the latency of a request."""
+        with self.lock:
+            self.samples.append(seconds)
+
+    def quantile(self, quantile):
+        """Return the latency quantile or None while samples are few."""
+        with self.lock:
+            if len(self.samples) < max(self.minimum, 1):
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * quantile))]
+
+
+class HedgedGet:
+    """Send a GET request again when it is slower than usual.
+
+    The second attempt goes out once the first one passes the latency
+    quantile of the recent requests, and the first answer wins. The loser
+    is closed when it finishes.
+    """
+
+    def __init__(self, get, workers=HEDGE_WORKERS, quantile=HEDGE_QUANTILE,
+                 window=None):
+        """Wrap the get function with a pool for the attempts."""
+        self.get = get
+        self.quantile = quantile
+        self.window = LatencyWindow() if window is None else window
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        """Send the request, hedging it when it is slow."""
+        delay = self.window.quantile(self.quantile)
+        if delay is None:
+            return self.attempt(kwargs)
+        first = self.submit(kwargs)
+        done, _ = wait((first,), timeout=delay)
+        if done:
+            return first.result()
+        pending = {first, self.submit(kwargs)}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next(
+                (future for future in done if future.exception() is None),
+                next(iter(done))
+            )
+            if winner.exception() is None or not pending:
+                break
+        API_HEDGES.inc(winner='first' if winner is first else 'hedge')
+        for future in pending:
+            future.add_done_callback(close_response)
+        return winner.result()
+
+    def submit(self, kwargs):
+        """Start an attempt on the pool, creating it on first use."""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+        return self.executor.submit(self.attempt, kwargs)
+
+    def attempt(self, kwargs):
+        """Send one request and record its latency."""
+        started = time.perf_counter()
+        response = self.get(**kwargs)
+        self.window.add(time.perf_counter() - started)
+        return response
+
+
+def close_response(future):
+    """Release the connection of a hedged attempt that lost."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+HEDGED_GET = HedgedGet(send_get)
+
+
+def http_get(**kwargs):
+    """Send a GET request, hedging slow ones when configured."""
+    if HEDGE_REQUESTS:
+        return HEDGED_GET(**kwargs)
+    return send_get(**kwargs)
+
+
+class FixedPollPolicy:
+    """Poll every tenant with the same period."""
+
+    def __init__(self, period=RETRY_PERIOD):
+        """Remember the polling period."""
+        self.period = period
+
+    def next_period(self, tenant, outcome):
+        """Return the delay before the next poll of a tenant."""
+        return self.period
+
+
+class AdaptivePollPolicy:
+    """Poll reviewed homeworks often and back off on silence or errors."""
+
+    def __init__(self, base=RETRY_PERIOD, minimum=POLL_MIN_PERIOD,
+                 maximum=POLL_MAX_PERIOD, backoff=POLL_BACKOFF,
+                 jitter=POLL_JITTER, rng=None):
+        """Configure the period bounds, backoff factor and jitter."""
+        self.base = base
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.periods = {}
+
+    def next_period(self, tenant, outcome):
+        """Return the delay before the next poll of a tenant."""
+        period = self.periods.get(tenant.key, self.base)
+        if outcome == POLL_ERROR:
+            period = min(period * self.backoff, self.maximum)
+        elif HomeworkStatus.REVIEWING in tenant.statuses.values():
+            period = self.minimum
+        elif outcome == POLL_CHANGED:
+            period = self.base
+        else:
+            period = min(max(period, self.base) * self.backoff, self.maximum)
+        self.periods[tenant.key] = period
+        return period * (1 + self.jitter * (2 * self.rng.random() - 1))
+
+
+POLL_POLICIES = {'fixed': FixedPollPolicy, 'adaptive': AdaptivePollPolicy}
+
+
+def make_poll_policy(name, period=RETRY_PERIOD):
+    """Create the polling policy with the given name and base period."""
+    if name not in POLL_POLICIES:
+        raise ValueError(POLL_POLICY_ERROR.format(
+            name=name, names=list(POLL_POLICIES)
+        ))
+    return POLL_POLICIES[name](period)
+
+
+class PollScheduler:
+    """Track when every tenant is due for the next poll."""
+
+    def __init__(self, policy, clock=time.monotonic):
+        """Use the policy to plan polls on the given clock."""
+        self.policy = policy
+        self.clock = clock
+        self.due = {}
+
+    def due_tenants(self, tenants):
+        """Return the tenants that should be polled now."""
+        for key in self.due.keys() - {tenant.key for tenant in tenants}:
+            del self.due[key]
+        now = self.clock()
+        return [
+            tenant for tenant in tenants
+            if self.due.get(tenant.key, now) <= now
+        ]
+
+    def record(self, tenants, outcomes):
+        """Plan the next poll of each tenant after its outcome."""
+        now = self.clock()
+        for tenant, outcome in zip(tenants, outcomes):
+            self.due[tenant.key] = now + self.policy.next_period(
+                tenant, outcome
+            )
+
+    def delay(self):
+        """Return the whole seconds until the next tenant is due."""
+        if not self.due:
+            return RETRY_PERIOD
+        return max(0, math.ceil(min(self.due.values()) - self.clock()))
+
+
+class TokenBucket:
+    """Allow a steady rate of events with short bursts."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        """Start with a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def wait(self):
+        """Return the seconds until the next event is allowed."""
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        """Spend a token on an event."""
+        self.tokens -= 1
+
+
+class OutboxChat:
+    """Pending messages and rate limit of one telegram chat."""
+
+    def __init__(self, send, bucket):
+        """Start with an empty queue."""
+        self.send = send
+        self.bucket = bucket
+        self.messages = []
+        self.attempts = 0
+        self.not_before = 0
+
+
+def coalesce(messages):
+    """Join as many pending messages as fit into one telegram message."""
+    count = 1
+    length = len(messages[0])
+    for message in messages[1:]:
+        length += len(message) + 2
+        if length > TELEGRAM_MESSAGE_LIMIT:
+            break
+        count += 1
+    return '\n\n'.join(messages[:count]), count
+
+
+class Outbox:
+    """Rate-limited telegram queue with coalescing and retries."""
+
+    def __init__(self, size=OUTBOX_SIZE, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 retry_delay=OUTBOX_RETRY_DELAY, workers=OUTBOX_WORKERS,
+                 clock=time.monotonic):
+        """Configure the queue bound, rate limits, retries and senders."""
+        self.size = size
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock)
+        self.chats = {}
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    def put(self, chat_id, send, message):
+        """Queue a message for a chat."""
+        with self.condition:
+            if self.pending >= self.size:
+                raise queue.Full(OUTBOX_FULL.format(size=self.size))
+            if chat_id not in self.chats:
+                self.chats[chat_id] = OutboxChat(send, TokenBucket(
+                    self.chat_rate, self.chat_burst, self.clock
+                ))
+            self.chats[chat_id].messages.append(message)
+            self.pending += 1
+
+    def take_ready(self):
+        """Pop a coalesced message for every chat allowed to send now."""
+        now = self.clock()
+        ready = []
+        for chat in self.chats.values():
+            if not chat.messages or chat.not_before > now:
+                continue
+            if chat.bucket.wait() or self.global_bucket.wait():
+                continue
+            chat.bucket.take()
+            self.global_bucket.take()
+            text, count = coalesce(chat.messages)
+            ready.append((chat, chat.messages[:count], text))
+            del chat.messages[:count]
+            self.pending -= count
+        return ready
+
+    def retry(self, chat, messages):
+        """Put failed messages back with an exponential backoff."""
+        with self.condition:
+            chat.attempts += 1
+            if chat.attempts >= self.max_attempts:
+                logging.error(OUTBOX_DROPPED.format(
+                    attempts=chat.attempts, count=len(messages)
+                ))
+                chat.attempts = 0
+                return
+            chat.messages[:0] = messages
+            self.pending += len(messages)
+            chat.not_before = (
+                self.clock() + self.retry_delay * 2 ** (chat.attempts - 1)
+            )
+
+    def defer(self, chat, messages, delay):
+        """Put messages back without counting a failed attempt."""
+        with self.condition:
+            chat.messages[:0] = messages
+            self.pending += len(messages)
+            chat.not_before = self.clock() + delay
+
+    def deliver(self, item):
+        """Send a coalesced message, putting it back on failure."""
+        chat, messages, text = item
+        try:
+            chat.send(text)
+            chat.attempts = 0
+        except CircuitOpenError as error:
+            self.defer(chat, messages, error.retry_after)
+        except Exception as error:
+            logging.error(MAIN_MESSAGE_ERROR.format(error=error))
+            self.retry(chat, messages)
+
+    def flush(self):
+        """Send everything the rate limits allow right now."""
+        with self.condition:
+            ready = self.take_ready()
+        if self.executor and len(ready) > 1:
+            list(self.executor.map(self.deliver, ready))
+        else:
+            for item in ready:
+                self.deliver(item)
+        with self.condition:
+            self.condition.notify()
+
+    def next_delay(self):
+        """Return the seconds until a pending message may be sent."""
+        now = self.clock()
+        delays = [
+            max(
+                chat.not_before - now,
+                chat.bucket.wait(),
+                self.global_bucket.wait()
+            )
+            for chat in self.chats.values() if chat.messages
+        ]
+        return min(delays) if delays else None
+
+    def run(self):
+        """Send deferred messages until the outbox is stopped."""
+        while not self.stopped.is_set():
+            self.flush()
+            with self.condition:
+                if not self.stopped.is_set():
+                    self.condition.wait(self.next_delay())
+
+    def start(self):
+        """Deliver deferred messages from a background thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread."""
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def drain(self, deadline):
+        """Send the pending messages until the deadline, then stop."""
+        self.stop(max(0, deadline - self.clock()))
+        while self.pending and self.clock() < deadline:
+            self.flush()
+            delay = self.next_delay()
+            if delay is None:
+                break
+            time.sleep(max(0, min(delay, deadline - self.clock())))
+        if self.pending:
+            logging.warning(SHUTDOWN_UNSENT.format(count=self.pending))
+
+
+def hash_value(key):
+    """Hash a key the same way in every process."""
+    return int(hashlib.sha256(str(key).encode()).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hashing of tenants onto workers."""
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        """Place every node on the ring several times."""
+        self.ring = sorted(
+            (hash_value(f'{node}#{replica}'), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in self.ring]
+
+    def owner(self, key):
+        """Return the node that owns the key, or None on an empty ring."""
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.hashes, hash_value(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class SqliteCoordinator:
+    """Worker membership kept as leases in a shared SQLite database."""
+
+    def __init__(self, path, worker_id, lease=WORKER_LEASE, clock=time.time):
+        """Open the database and create the worker table."""
+        self.worker_id = worker_id
+        self.lease = lease
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False
+        )
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS workers '
+                '(worker_id TEXT PRIMARY KEY, expires REAL NOT NULL)'
+            )
+
+    def heartbeat(self):
+        """Extend the lease of this worker."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO workers (worker_id, expires) '
+                'VALUES (?, ?)',
+                (self.worker_id, self.clock() + self.lease)
+            )
+
+    def members(self):
+        """Return the workers with a live lease."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT worker_id FROM workers WHERE expires > ? '
+                'ORDER BY worker_id',
+                (self.clock(),)
+            ).fetchall()
+        return [worker_id for worker_id, in rows]
+
+    def run(self):
+        """Renew the lease until the coordinator is stopped."""
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as error:
+                logging.error(WORKER_HEARTBEAT_ERROR.format(error=error))
+
+    def start(self):
+        """Join the workers and renew the lease in the background."""
+        self.heartbeat()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Leave the workers so the others take over right away."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM workers WHERE worker_id = ?', (self.worker_id,)
+            )
+
+
+class Shard:
+    """Tenants served by this worker among all running workers."""
+
+    def __init__(self, store, coordinator=None):
+        """Serve every tenant unless a coordinator is given."""
+        self.store = store
+        self.coordinator = coordinator
+        self.owned = set()
+
+    def select(self, tenants):
+        """Return the owned tenants, loading the state of new ones."""
+        if self.coordinator is None:
+            selected = tenants
+        else:
+            selected = self.own(tenants)
+        keys = {tenant.key for tenant in selected}
+        if keys != self.owned:
+            for tenant in selected:
+                if tenant.key not in self.owned:
+                    tenant.restore(self.store.load(tenant.key))
+            logging.info(SHARD_CHANGED.format(
+                worker=WORKER_ID, count=len(selected), total=len(tenants)
+            ))
+            self.owned = keys
+        return selected
+
+    def own(self, tenants):
+        """Return the tenants that hash onto this worker.
+
+        A worker whose lease has lapsed owns nothing until its heartbeat
+        renews the lease, since the other workers have taken over.
+        """
+        worker_id = self.coordinator.worker_id
+        try:
+            members = self.coordinator.members()
+        except sqlite3.Error as error:
+            logging.error(WORKER_HEARTBEAT_ERROR.format(error=error))
+            members = []
+        if worker_id not in members:
+            logging.warning(WORKER_LEASE_LOST.format(worker=worker_id))
+            return []
+        ring = HashRing(members)
+        return [
+            tenant for tenant in tenants if ring.owner(tenant.key) == worker_id
+        ]
+
+    def owns(self, tenant):
+        """Check that this worker serves the tenant."""
+        return tenant.key in self.owned
+
+
+def token_digest(token):
+    """Identify a Practicum token without storing it."""
+    return hashlib.sha256(str(token).encode()).hexdigest()[:16]
+
+
+def tenant_key(token, chat_id):
+    """Identify a subscription without storing its token."""
+    return f'{chat_id}:{token_digest(token)}'
+
+
+class HomeworkStream:
+    """Incrementally decoded homework_statuses response."""
+
+    def __init__(self, chunks, parameters, close=None):
+        """Decode the response body from an iterable of byte chunks."""
+        self.chunks = iter(chunks)
+        self.parameters = parameters
+        self.close = close or (lambda: None)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+        self.fields = {}
+        self.count = 0
+
+    def read(self):
+        """Replace the consumed part of the buffer with the next chunk."""
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Return the next significant character or an empty string."""
+        while True:
+            self.position = JSON_WHITESPACE.match(
+                self.buffer, self.position
+            ).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                return ''
+
+    def skip(self, char):
+        """Consume the next character if it is the given one."""
+        if self.peek() == char:
+            self.position += 1
+            return True
+        return False
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(
+                    self.buffer, self.position
+                )
+                if end < len(self.buffer) or self.exhausted:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.read()
+
+    def homeworks(self):
+        """Yield the homeworks one by one while checking the structure."""
+        if not self.skip('{'):
+            raise TypeError(CHECK_RESPONSE_ISITANSE_DICTIONARY.format(
+                type_of_response=type(self.value())
+            ))
+        found = False
+        while self.peek() not in ('}', ''):
+            key = self.value()
+            self.skip(':')
+            if key == 'homeworks':
+                found = True
+                yield from self.items()
+            else:
+                self.fields[key] = self.value()
+                check_api_errors(self.fields, self.parameters)
+            self.skip(',')
+        if not found:
+            raise KeyError(HOMEWORKS_KEY_ERROR)
+
+    def items(self):
+        """Yield the items of the homeworks list."""
+        if not self.skip('['):
+            raise TypeError(CHECK_RESPONSE_LISTS_ISITANSE.format(
+                incorrect_type=type(self.value())
+            ))
+        while not self.skip(']'):
+            self.count += 1
+            yield self.value()
+            self.skip(',')
+
+
+class ResponseCache:
+    """Validators and body digests of recent API responses."""
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        """Keep at most the given number of responses."""
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def validators(self, key):
+        """Return the conditional request headers for a cache key."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return {}
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    @staticmethod
+    def describe(response):
+        """Return the validators and body digest of a response."""
+        return (
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            hashlib.sha256(
+                VOLATILE_FIELDS.sub(b'', response.content)
+            ).hexdigest()
+        )
+
+    def unchanged(self, key, entry):
+        """Check that a response matches the cached one."""
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+        return cached is not None and cached[2] == entry[2]
+
+    def store(self, key, entry):
+        """Remember a checked response, evicting the oldest ones."""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class DescribedResponse:
+    """API response known by its digest, decoded and checked on demand.
+
+    A response whose digest a tenant has already seen is never decoded.
+    When several tenants share the response, it is decoded only once.
+    """
+
+    def __init__(self, response, parameters):
+        """Describe the response without decoding it."""
+        self.response = response
+        self.parameters = parameters
+        self.entry = ResponseCache.describe(response)
+        self.decoded = None
+        self.lock = threading.Lock()
+
+    def decode(self):
+        """Decode and check the body on first use."""
+        with self.lock:
+            if self.decoded is None:
+                api_response = self.response.json()
+                check_api_errors(api_response, self.parameters)
+                check_response(api_response)
+                self.decoded = api_response
+        return self.decoded
+
+
+def make_headers(token):
+    """Build the authorization headers for a Practicum token."""
+    return {'Authorization': f'OAuth {token}'}
+
+
+def telegram_outage(error):
+    """Tell whether a send error means telegram itself is unavailable."""
+    return isinstance(
+        error, (telegram.error.NetworkError, telegram.error.RetryAfter)
+    ) and not isinstance(error, telegram.error.BadRequest)
+
+
+def send_chat_message(bot, chat_id, message):
+    """Send a message to the given telegram chat."""
+    TELEGRAM_BREAKER.before()
+    started = time.perf_counter()
+    try:
+        bot.send_message(chat_id, message)
+    except Exception as error:
+        SEND_FAILURES.inc()
+        TELEGRAM_BREAKER.record(not telegram_outage(error))
+        raise
+    finally:
+        SEND_LATENCY.observe(time.perf_counter() - started)
+    TELEGRAM_BREAKER.record(True)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(SEND_MESSAGE_FOR_LOG.format(message=message))
+
+
+class LazyBot:
+    """Telegram bot created when the first message is sent."""
+
+    def __init__(self, create):
+        """Remember how to create the bot."""
+        self.create = create
+        self.bot = None
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        """Create the bot if needed and send the message."""
+        with self.lock:
+            if self.bot is None:
+                self.bot = self.create()
+        return self.bot.send_message(chat_id, text)
+
+
 def send_message(bot, message):
     """Send a message to telegram."""
-    bot.send_message(TELEGRAM_CHAT_ID, message)
-    logging.debug(SEND_MESSAGE_FOR_LOG.format(message=message))
+    send_chat_message(bot, TELEGRAM_CHAT_ID, message)
 
 
 def get_api_answer(timestamp):
     """Get an API response."""
+    return request_api_answer(HEADERS, timestamp)
+
+
+def request_api_answer(headers, timestamp):
+    """Get an API response for the given authorization headers."""
+    response_api_parameters = dict(
+        url=ENDPOINT, headers=headers, params={'from_date': timestamp}
+    )
+    api_response = send_api_request(response_api_parameters).json()
+    check_api_errors(api_response, response_api_parameters)
+    return api_response
+
+
+def stream_api_answer(headers, timestamp):
+    """Open an API response for incremental parsing."""
+    response_api_parameters = dict(
+        url=ENDPOINT, headers=headers, params={'from_date': timestamp}
+    )
+    homework_statuses = send_api_request(
+        response_api_parameters, stream=True
+    )
+    return HomeworkStream(
+        homework_statuses.iter_content(STREAM_CHUNK_SIZE),
+        response_api_parameters,
+        homework_statuses.close
+    )
+
+
+def described_api_answer(headers, timestamp, validators=None):
+    """Get an API response with its validators and body digest."""
+    response_api_parameters = dict(
+        url=ENDPOINT,
+        headers={**headers, **(validators or {})},
+        params={'from_date': timestamp}
+    )
+    homework_statuses = send_api_request(
+        response_api_parameters,
+        expected=(HTTPStatus.OK, HTTPStatus.NOT_MODIFIED)
+    )
+    if homework_statuses.status_code == HTTPStatus.NOT_MODIFIED:
+        return NOT_MODIFIED
+    return DescribedResponse(homework_statuses, response_api_parameters)
+
+
+def cached_api_answer(cache, key, fetch, timestamp, conditional=True):
+    """Get an API response unless the tenant has already seen it.
+
+    Entries are kept per tenant: subscriptions of one token poll at
+    different times and must not answer each other's polls. A conditional
+    request is only sent when the fetch is not shared between tenants.
+    The entry is stored by apply_response once the changes are queued, so
+    a failed notification is retried on the next poll.
+    """
+    cache_key = (key, timestamp)
+    answer = fetch(timestamp, cache.validators(cache_key)) if (
+        conditional
+    ) else fetch(timestamp)
+    if answer is NOT_MODIFIED or cache.unchanged(cache_key, answer.entry):
+        CACHE_HITS.inc()
+        return NOT_MODIFIED
+    return CachedAnswer(
+        answer.decode(), partial(cache.store, cache_key, answer.entry)
+    )
+
+
+def raw_api_answer(headers, timestamp):
+    """Get an undecoded API response to decode in a worker process."""
     response_api_parameters = dict(
-        url=ENDPOINT, headers=HEADERS, params={'from_date': timestamp}
+        url=ENDPOINT, headers=headers, params={'from_date': timestamp}
+    )
+    return RawResponse(
+        send_api_request(response_api_parameters).content,
+        response_api_parameters
     )
+
+
+def decode_response(raw):
+    """Decode, check and render an API response."""
+    api_response = json.loads(raw.body)
+    check_api_errors(api_response, raw.parameters, count=False)
+    check_response(api_response)
+    homeworks = api_response['homeworks']
+    rendered = []
+    for homework in reversed(homeworks):
+        record = Homework.from_dict(homework)
+        rendered.append((record.key, record.status, record.message))
+    return DecodedResponse(
+        rendered, api_response.get('current_date') if homeworks else None
+    )
+
+
+def decode_batch(raws):
+    """Decode a batch of API responses, returning errors instead."""
+    results = []
+    for raw in raws:
+        try:
+            results.append(decode_response(raw))
+        except Exception as error:
+            results.append(error)
+    return results
+
+
+def api_error(error_class, message, cause):
+    """Build an API error that remembers its stable cause."""
+    error = error_class(message)
+    error.cause = cause
+    return error
+
+
+def send_api_request(response_api_parameters, expected=(HTTPStatus.OK,),
+                     **kwargs):
+    """Send a request to the API and check its status code."""
+    API_BREAKER.before()
+    started = time.perf_counter()
     try:
-        homework_statuses = requests.get(**response_api_parameters)
+        homework_statuses = http_get(
+            **response_api_parameters,
+            timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT), **kwargs
+        )
     except requests.RequestException as error:
-        raise ConnectionError(GET_API_REQUEST_EXCEPTION.format(
+        API_RESPONSES.inc(code='exception')
+        API_BREAKER.record(False)
+        raise api_error(ConnectionError, GET_API_REQUEST_EXCEPTION.format(
             exception=error, **response_api_parameters
-        ))
-    if homework_statuses.status_code != HTTPStatus.OK:
-        raise ValueError(GET_API_STATUS_CODE_EXCEPTIONS.format(
+        ), type(error).__name__) from error
+    finally:
+        API_LATENCY.observe(time.perf_counter() - started)
+    API_RESPONSES.inc(code=int(homework_statuses.status_code))
+    API_BREAKER.record(
+        homework_statuses.status_code < HTTPStatus.INTERNAL_SERVER_ERROR
+        and homework_statuses.status_code != HTTPStatus.TOO_MANY_REQUESTS
+    )
+    if homework_statuses.status_code not in expected:
+        raise api_error(ValueError, GET_API_STATUS_CODE_EXCEPTIONS.format(
             status_code=homework_statuses.status_code,
             **response_api_parameters
-        ))
-    api_response = homework_statuses.json()
+        ), int(homework_statuses.status_code))
+    return homework_statuses
+
+
+def check_api_errors(api_response, response_api_parameters, count=True):
+    """Check that the API response does not report an error.
+
+    Worker processes pass count=False: their metrics never reach
+    /metrics, so the parent counts the error key of the returned error.
+    """
     for error_key in ('error', 'code'):
         if error_key in api_response:
-            raise ValueError(GET_API_ERROR_IN_JSON.format(
+            if count:
+                API_JSON_ERRORS.inc(key=error_key)
+            error = api_error(ValueError, GET_API_ERROR_IN_JSON.format(
                 name_error=error_key,
                 error_value=api_response[error_key], **response_api_parameters
-            ))
-    return api_response
+            ), error_key)
+            error.error_key = error_key
+            raise error
 
 
 def check_response(response):
@@ -134,56 +1680,794 @@ def check_response(response):
 
 def parse_status(homework):
     """Collect a message to send in a telegram."""
-    if 'homework_name' not in homework:
-        raise KeyError(HOMEWORK_NAME_KEY_ERROR)
-    status = homework['status']
-    if status not in HOMEWORK_VERDICTS:
-        raise ValueError(STATUS_VALUE_ERROR.format(status=status))
-    return PARSE_STATUS_RESULT.format(
-        homework_name=homework['homework_name'],
-        verdict=HOMEWORK_VERDICTS[status]
+    return Homework.from_dict(homework).message
+
+
+class SingleFlight:
+    """One API request per (token, from_date) shared by concurrent callers.
+
+    A finished result is kept for ttl seconds, so polls of the same token
+    that arrive shortly after each other do not repeat the request.
+    """
+
+    def __init__(self, ttl=SINGLE_FLIGHT_TTL, clock=time.monotonic):
+        """Start with no requests in flight."""
+        self.ttl = ttl
+        self.clock = clock
+        self.calls = {}
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch(self, token, fetch, timestamp):
+        """Request the API for the token once, sharing the result."""
+        key = (token, timestamp)
+        with self.lock:
+            now = self.clock()
+            while self.results and next(iter(self.results.values()))[0] <= now:
+                self.results.popitem(last=False)
+            if key in self.results:
+                return self.results[key][1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fetch(timestamp)
+        except Exception as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            if self.ttl:
+                with self.lock:
+                    self.results[key] = (self.clock() + self.ttl, result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+def make_fetcher(headers, cache, flights=None, key=None):
+    """Choose how a tenant requests the API."""
+    if STREAM_HOMEWORKS and not PROCESS_POOL_WORKERS:
+        return partial(stream_api_answer, headers)
+    if PROCESS_POOL_WORKERS:
+        fetch = partial(raw_api_answer, headers)
+    elif cache is not None:
+        fetch = partial(described_api_answer, headers)
+    else:
+        fetch = partial(request_api_answer, headers)
+    if flights is not None:
+        fetch = partial(
+            flights.fetch, token_digest(headers['Authorization']), fetch
+        )
+    if cache is None or PROCESS_POOL_WORKERS:
+        return fetch
+    return partial(
+        cached_api_answer, cache, key, fetch, conditional=flights is None
     )
 
 
+def fan_out(outbox, chats, message):
+    """Queue one rendered message for every chat of a subscription."""
+    for chat_id, send in chats:
+        outbox.put(chat_id, send, message)
+
+
+def load_tenants(bot, outbox):
+    """Build the tenants served by this process."""
+    ignored = [
+        name for name in ('RESPONSE_CACHE', 'STREAM_HOMEWORKS')
+        if PROCESS_POOL_WORKERS and globals()[name]
+    ]
+    if ignored:
+        logging.warning(PROCESS_POOL_IGNORED.format(names=', '.join(ignored)))
+    cache = ResponseCache() if RESPONSE_CACHE else None
+    if not SUBSCRIPTIONS_FILE:
+        key = tenant_key(PRACTICUM_TOKEN, TELEGRAM_CHAT_ID)
+        return [Tenant(
+            key,
+            make_fetcher(HEADERS, cache, key=key),
+            partial(
+                outbox.put, TELEGRAM_CHAT_ID, partial(send_message, bot)
+            ),
+            token_digest(PRACTICUM_TOKEN)
+        )]
+    with open(SUBSCRIPTIONS_FILE, encoding='utf-8') as file:
+        subscriptions = json.load(file)
+    flights = SingleFlight()
+    tenants = []
+    for subscription in subscriptions:
+        chat_ids = subscription.get('chat_ids', [subscription.get('chat_id')])
+        key = tenant_key(subscription['token'], ','.join(map(str, chat_ids)))
+        tenants.append(Tenant(
+            key,
+            make_fetcher(
+                make_headers(subscription['token']), cache, flights, key
+            ),
+            partial(fan_out, outbox, [
+                (chat_id, partial(send_chat_message, bot, chat_id))
+                for chat_id in chat_ids
+            ]),
+            token_digest(subscription['token']),
+            partial(
+                outbox.put, chat_ids[0],
+                partial(send_chat_message, bot, chat_ids[0])
+            )
+        ))
+    return tenants
+
+
+def diff_homeworks(statuses, homeworks):
+    """Collect a message for every homework whose status has changed."""
+    events = []
+    for homework in reversed(homeworks):
+        record = Homework.from_dict(homework)
+        if statuses.get(record.key) != record.status:
+            events.append((record.key, record.status, record.message))
+    return events
+
+
+def diff_stream(statuses, stream):
+    """Collect the status changes from a streamed response.
+
+    Homeworks come newest first, so everything after the first unchanged
+    homework has been seen before and is only skipped over.
+    """
+    events = []
+    seen = False
+    try:
+        for homework in stream.homeworks():
+            if seen:
+                continue
+            record = Homework.from_dict(homework)
+            if statuses.get(record.key) == record.status:
+                seen = True
+                continue
+            events.append((record.key, record.status, record.message))
+    finally:
+        stream.close()
+    events.reverse()
+    return events, stream.fields.get('current_date') if stream.count else None
+
+
+def collect_events(statuses, response):
+    """Check an API response and find the status changes in it.
+
+    The window only moves past responses with homeworks: an empty answer
+    for the same from_date stays the same and can be served from cache.
+    """
+    if response is NOT_MODIFIED:
+        return [], None
+    if isinstance(response, DecodedResponse):
+        return [
+            event for event in response.homeworks
+            if statuses.get(event[0]) != event[1]
+        ], response.current_date
+    if isinstance(response, HomeworkStream):
+        return diff_stream(statuses, response)
+    check_response(response)
+    homeworks = response['homeworks']
+    return (
+        diff_homeworks(statuses, homeworks),
+        response.get('current_date') if homeworks else None
+    )
+
+
+def apply_response(tenant, response, move_window=True):
+    """Notify the tenant about the status changes in a response."""
+    commit = None
+    if isinstance(response, CachedAnswer):
+        response, commit = response
+    with tenant.lock:
+        events, current_date = collect_events(tenant.statuses, response)
+        tenant.last_error = ''
+        if not tenant.timestamp and not tenant.statuses:
+            for key, status, _ in events[:-1]:
+                tenant.statuses[key] = status
+            events = events[-1:]
+        for key, status, message in events:
+            tenant.notify(message)
+            tenant.statuses[key] = status
+        if current_date is not None and move_window:
+            tenant.timestamp = current_date
+        if commit is not None:
+            commit()
+    return POLL_CHANGED if events else POLL_IDLE
+
+
+def error_fingerprint(error):
+    """Identify an error by its class and its stable cause.
+
+    API errors carry their status code, error key or request exception
+    class; the request details in their text are left out. Other errors
+    are told apart by their text.
+    """
+    cause = getattr(error, 'cause', str(error))
+    return hashlib.sha256(
+        f'{type(error).__name__}:{cause}'.encode()
+    ).hexdigest()[:16]
+
+
+class ErrorIndex:
+    """Recent errors of a tenant by fingerprint, bounded in size and age."""
+
+    def __init__(self, size=ERROR_INDEX_SIZE, ttl=ERROR_TTL,
+                 summary_period=ERROR_SUMMARY_PERIOD, clock=time.monotonic):
+        """Start with no known errors."""
+        self.size = size
+        self.ttl = ttl
+        self.summary_period = summary_period
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def note(self, fingerprint, reported=False):
+        """Count an error and return the count to report, or 0 to skip it."""
+        now = self.clock()
+        last_seen, count, reported_at = self.entries.pop(
+            fingerprint, (now, 0, None)
+        )
+        if now - last_seen >= self.ttl:
+            count, reported_at = 0, None
+        count += 1
+        if reported and reported_at is None:
+            reported_at = now
+        report = reported_at is None or (
+            now - reported_at >= self.summary_period
+        )
+        self.entries[fingerprint] = (
+            now, count, now if report else reported_at
+        )
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return count if report else 0
+
+    def forget(self, fingerprint):
+        """Drop an error so its next occurrence is reported again."""
+        self.entries.pop(fingerprint, None)
+
+
+def report_error(tenant, error):
+    """Log a failed poll and tell the tenant about new or lasting errors."""
+    if isinstance(error, CircuitOpenError):
+        return POLL_ERROR
+    error_message = MAIN_API_ERROR.format(error=error)
+    logging.error(error_message)
+    fingerprint = error_fingerprint(error)
+    with tenant.lock:
+        restored = tenant.errors is None and fingerprint == tenant.last_error
+        if tenant.errors is None:
+            tenant.errors = ErrorIndex()
+        count = tenant.errors.note(fingerprint, reported=restored)
+        if not count:
+            return POLL_ERROR
+        try:
+            tenant.alert(error_message if count == 1 else (
+                MAIN_API_STILL_FAILING.format(count=count, error=error)
+            ))
+            tenant.last_error = fingerprint
+        except Exception as error:
+            tenant.errors.forget(fingerprint)
+            logging.error(MAIN_MESSAGE_ERROR.format(error=error))
+    return POLL_ERROR
+
+
+def poll_tenant(tenant):
+    """Run one polling cycle for a tenant."""
+    try:
+        return apply_response(tenant, tenant.fetch(tenant.timestamp))
+    except Exception as error:
+        return report_error(tenant, error)
+
+
+def fetch_tenant(tenant):
+    """Request the API for a tenant, returning the error on failure."""
+    try:
+        return tenant.fetch(tenant.timestamp)
+    except Exception as error:
+        return error
+
+
+def apply_decoded(tenant, decoded):
+    """Apply a response decoded in a worker process."""
+    if isinstance(decoded, Exception):
+        return report_error(tenant, decoded)
+    try:
+        return apply_response(tenant, decoded)
+    except Exception as error:
+        return report_error(tenant, error)
+
+
+def poll_tenants_in_processes(tenants, executor, process_pool):
+    """Fetch in threads, decode in worker processes, notify from here."""
+    fetched = list(executor.map(fetch_tenant, tenants))
+    raws = [
+        (tenant, response) for tenant, response in zip(tenants, fetched)
+        if isinstance(response, RawResponse)
+    ]
+    batches = [
+        [raw for _, raw in raws[start:start + PROCESS_BATCH_SIZE]]
+        for start in range(0, len(raws), PROCESS_BATCH_SIZE)
+    ]
+    results = [
+        result for batch in process_pool.map(decode_batch, batches)
+        for result in batch
+    ]
+    for result in results:
+        if getattr(result, 'error_key', None):
+            API_JSON_ERRORS.inc(key=result.error_key)
+    decoded = {
+        tenant.key: result for (tenant, _), result in zip(raws, results)
+    }
+    return [
+        apply_decoded(tenant, decoded.get(tenant.key, response))
+        for tenant, response in zip(tenants, fetched)
+    ]
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept homework statuses pushed in the API response format."""
+
+    def do_POST(self):
+        """Notify the subscribers of the pushed statuses right away."""
+        authorization = self.headers.get('Authorization', '')
+        tenants = [
+            tenant for tenant in self.server.tenants.get(
+                token_digest(authorization.removeprefix('OAuth ')), []
+            )
+            if self.server.shard.owns(tenant)
+        ]
+        if self.path != '/homeworks' or not tenants:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(WEBHOOK_LENGTH_ERROR.format(length=length))
+            if length > WEBHOOK_MAX_BODY:
+                self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                return
+            payload = json.loads(self.rfile.read(length))
+            for tenant in tenants:
+                apply_response(tenant, payload, move_window=False)
+        except Exception as error:
+            logging.error(WEBHOOK_ERROR.format(error=error))
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+        self.server.outbox.flush()
+        self.send_response(HTTPStatus.NO_CONTENT)
+        self.end_headers()
+
+    def log_message(self, *args):
+        """Do not log every push."""
+
+
+def start_webhook_server(host, port, tenants, outbox, shard):
+    """Accept pushed homework statuses from a background thread."""
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    server.outbox = outbox
+    server.shard = shard
+    server.tenants = {}
+    for tenant in tenants:
+        server.tenants.setdefault(tenant.digest, []).append(tenant)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(WEBHOOK_STARTED.format(host=host, port=server.server_port))
+    return server
+
+
+def poll_tenants(tenants, executor, deadline=0, limit=None):
+    """Run one polling cycle for every tenant.
+
+    With a deadline, tenants whose poll has not finished in time count as
+    failed. Their poll goes on in the background and they are not polled
+    again until it ends. The limit callable may bring the deadline
+    forward, for example when the bot is stopping.
+    """
+    if not deadline and limit is None:
+        if len(tenants) == 1:
+            return [poll_tenant(tenants[0])]
+        return list(executor.map(poll_tenant, tenants))
+    started = time.monotonic()
+    end = started + deadline if deadline else math.inf
+    late = {start_poll(tenant, executor) for tenant in tenants}
+    while late:
+        remaining = cycle_remaining(end, limit)
+        if remaining <= 0:
+            break
+        _, late = wait(late, timeout=min(remaining, SHUTDOWN_CHECK))
+    report_late(late, time.monotonic() - started)
+    return [
+        POLL_ERROR if tenant.polling in late else tenant.polling.result()
+        for tenant in tenants
+    ]
+
+
+def cycle_remaining(end, limit):
+    """Return how long the cycle may still wait for its polls."""
+    return (end if limit is None else limit(end)) - time.monotonic()
+
+
+def start_poll(tenant, executor):
+    """Submit the poll of a tenant unless its previous one still runs."""
+    if tenant.polling is None or tenant.polling.done():
+        tenant.polling = executor.submit(poll_tenant, tenant)
+    return tenant.polling
+
+
+def report_late(late, seconds):
+    """Log the polls that missed the cycle deadline."""
+    if late:
+        logging.warning(CYCLE_DEADLINE_EXCEEDED.format(
+            seconds=seconds, count=len(late)
+        ))
+
+
+def save_tenants(store, tenants):
+    """Persist the state of every tenant after a polling cycle."""
+    try:
+        store.save_many((tenant.key, tenant.snapshot()) for tenant in tenants)
+    except Exception as error:
+        logging.error(STATE_SAVE_ERROR.format(error=error))
+
+
+def run_cycle(tenants, executor, process_pool=None, limit=None):
+    """Poll the tenants in the configured mode and return the outcomes."""
+    if process_pool is not None:
+        return poll_tenants_in_processes(tenants, executor, process_pool)
+    return poll_tenants(tenants, executor, CYCLE_DEADLINE, limit)
+
+
+def poll_due_tenants(scheduler, tenants, executor, process_pool, outbox,
+                     store, limit=None):
+    """Poll the due tenants, send their messages and save their state."""
+    due = scheduler.due_tenants(tenants)
+    scheduler.record(due, run_cycle(due, executor, process_pool, limit))
+    outbox.flush()
+    save_tenants(store, due)
+
+
+def next_delay(scheduler, coordinator=None):
+    """Return how long to sleep before the next cycle.
+
+    With a coordinator the loop wakes at least once per heartbeat, so a
+    renewed lease or a dead worker's tenants are picked up right away
+    even when none of this worker's tenants is due.
+    """
+    delay = scheduler.delay()
+    if coordinator is None:
+        return delay
+    return min(delay, coordinator.lease / 3)
+
+
+class SleepInterrupted(Exception):
+    """Raised by the signal handler to cut the sleep between cycles short."""
+
+
+class GracefulShutdown:
+    """Stop the main loop cleanly on SIGTERM or SIGINT.
+
+    The first signal lets the current cycle finish and wakes the loop if it
+    sleeps; a second one interrupts right away. If the cleanup outlives
+    the deadline, the process is killed by a watchdog.
+    """
+
+    SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT, clock=time.monotonic):
+        """Start with no shutdown requested."""
+        self.timeout = timeout
+        self.clock = clock
+        self.requested_at = None
+        self.sleeping = False
+        self.previous = {}
+        self.watchdog = None
+
+    @property
+    def requested(self):
+        """Tell whether a stop signal has arrived."""
+        return self.requested_at is not None
+
+    def install(self):
+        """Handle the stop signals instead of the default handlers."""
+        for signum in self.SIGNALS:
+            self.previous[signum] = signal.signal(signum, self.handle)
+
+    def restore(self):
+        """Give the stop signals back and cancel the watchdog."""
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+        self.previous = {}
+        if self.watchdog:
+            self.watchdog.cancel()
+
+    def handle(self, signum, frame):
+        """Start the shutdown, or interrupt at once on a repeated signal."""
+        if self.requested:
+            raise KeyboardInterrupt
+        self.requested_at = self.clock()
+        logging.info(SHUTDOWN_STARTED.format(
+            signal=signal.Signals(signum).name, seconds=self.timeout
+        ))
+        self.watchdog = threading.Timer(
+            self.timeout + SHUTDOWN_GRACE, self.force
+        )
+        self.watchdog.daemon = True
+        self.watchdog.start()
+        if self.sleeping:
+            raise SleepInterrupted
+
+    def force(self):
+        """Kill the process that failed to stop in time."""
+        logging.critical(SHUTDOWN_FORCED)
+        logging.shutdown()
+        os._exit(1)
+
+    def limit(self, deadline):
+        """Bring a cycle deadline forward once a shutdown is requested.
+
+        The cycle gets half of the shutdown timeout, the other half is left
+        for saving the state and draining the outbox.
+        """
+        if not self.requested:
+            return deadline
+        return min(deadline, self.requested_at + self.timeout / 2)
+
+    def deadline(self):
+        """Return the time by which the cleanup has to finish."""
+        return (
+            self.requested_at if self.requested else self.clock()
+        ) + self.timeout
+
+    def __enter__(self):
+        """Mark the loop as sleeping, so a signal may wake it."""
+        self.sleeping = True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Swallow the wake-up of a signal."""
+        self.sleeping = False
+        return exc_type is SleepInterrupted
+
+
+def stop_services(shutdown, outbox, store, tenants, shard, coordinator):
+    """Stop the background work, saving and draining it on a signal."""
+    if shutdown.requested:
+        save_tenants(
+            store, [tenant for tenant in tenants if shard.owns(tenant)]
+        )
+        outbox.drain(shutdown.deadline())
+    else:
+        outbox.stop()
+    if coordinator:
+        coordinator.stop()
+    shutdown.restore()
+
+
 def main():
     """The basic logic of the bot's operation."""
     check_tokens()
-    bot = telegram.Bot(token=TELEGRAM_TOKEN)
-    timestamp = 0
-    old_message = ''
 
-    while True:
-        try:
-            response = get_api_answer(timestamp)
-            check_response(response)
-            homeworks = response['homeworks']
-            if homeworks:
-                message = parse_status(homeworks[0])
-            else:
-                message = old_message
-            if message != old_message:
-                send_message(bot, message)
-                timestamp = response.get('current_date', timestamp)
-                old_message = message
-        except Exception as error:
-            error_message = MAIN_API_ERROR.format(error=error)
-            logging.error(error_message)
-            if error_message != old_message:
-                try:
-                    send_message(bot, error_message)
-                    old_message = error_message
-                except Exception as error:
-                    logging.error(MAIN_MESSAGE_ERROR.format(error=error))
-        time.sleep(RETRY_PERIOD)
+    def create_bot():
+        """Create the telegram bot, importing the library on first use."""
+        started = time.perf_counter()
+        bot = telegram.Bot(token=TELEGRAM_TOKEN)
+        logging.debug(BOT_CREATED.format(
+            seconds=time.perf_counter() - started
+        ))
+        return bot
 
+    bot = LazyBot(create_bot)
+    outbox = Outbox()
+    tenants = load_tenants(bot, outbox)
+    store = make_state_store(STATE_DB)
+    coordinator = SqliteCoordinator(COORDINATOR_DB, WORKER_ID) if (
+        COORDINATOR_DB
+    ) else None
+    shard = Shard(store, coordinator)
+    logging.info(TENANTS_LOADED.format(count=len(tenants)))
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        level=logging.DEBUG,
-        handlers=(
-            logging.FileHandler(f'{__name__}.log'), logging.StreamHandler()
-        ),
-        format='%(asctime)s, %(levelname)s, %(message)s'
+    scheduler = PollScheduler(make_poll_policy(
+        POLL_POLICY, WEBHOOK_RECONCILE_PERIOD if WEBHOOK_PORT else RETRY_PERIOD
+    ))
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    webhook = start_webhook_server(
+        WEBHOOK_HOST, WEBHOOK_PORT, tenants, outbox, shard
+    ) if WEBHOOK_PORT else None
+    if coordinator:
+        coordinator.start()
+    outbox.start()
+    shutdown = GracefulShutdown()
+    shutdown.install()
+    executor = ThreadPoolExecutor(max_workers=POLL_WORKERS)
+    try:
+        with ProcessPoolExecutor(PROCESS_POOL_WORKERS) if (
+            PROCESS_POOL_WORKERS
+        ) else nullcontext() as process_pool:
+            while not shutdown.requested:
+                started = time.monotonic()
+                poll_due_tenants(
+                    scheduler, shard.select(tenants), executor, process_pool,
+                    outbox, store, shutdown.limit
+                )
+                OUTBOX_DEPTH.set(outbox.pending)
+                if HTTP_KEEP_ALIVE:
+                    logging.debug(
+                        CONNECTION_STATS.format(**HTTP_SESSION.stats())
+                    )
+                CYCLE_DURATION.observe(time.monotonic() - started)
+                delay = next_delay(scheduler, coordinator)
+                sleep_started = time.monotonic()
+                with shutdown:
+                    time.sleep(delay)
+                SLEEP_DRIFT.observe(
+                    max(0, time.monotonic() - sleep_started - delay)
+                )
+    finally:
+        executor.shutdown(
+            wait=not shutdown.requested, cancel_futures=shutdown.requested
+        )
+        if webhook:
+            webhook.shutdown()
+        stop_services(shutdown, outbox, store, tenants, shard, coordinator)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line."""
+
+    def format(self, record):
+        """Return the record as a JSON string."""
+        data = dict(
+            time=self.formatTime(record),
+            level=record.levelname,
+            logger=record.name,
+            thread=record.threadName,
+            message=record.getMessage()
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        return json.dumps(data, ensure_ascii=False)
+
+
+class ErrorSampler(logging.Filter):
+    """Let through only a few repeats of the same error per time window."""
+
+    def __init__(self, window=LOG_SAMPLE_WINDOW, burst=LOG_SAMPLE_BURST,
+                 size=LOG_SAMPLE_KEYS, clock=time.monotonic):
+        """Start with no seen errors."""
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.size = size
+        self.clock = clock
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        """Drop the record if its message was repeated too often."""
+        if record.levelno < logging.ERROR:
+            return True
+        key = (record.levelno, record.getMessage())
+        now = self.clock()
+        with self.lock:
+            started, count, suppressed = self.seen.pop(key, (now, 0, 0))
+            if now - started >= self.window:
+                started, count = now, 0
+            count += 1
+            passed = count <= self.burst
+            self.seen[key] = (started, count, 0 if passed else suppressed + 1)
+            if len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+        if passed and suppressed:
+            record.msg = LOG_SUPPRESSED.format(
+                message=record.getMessage(), count=suppressed
+            )
+            record.args = None
+            record.suppressed = suppressed
+        return passed
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    """Log file rotated when it grows too big or too old."""
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=0,
+                 clock=time.time):
+        """Open the log file and plan the first time-based rotation."""
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count,
+            encoding='utf-8'
+        )
+        self.interval = interval
+        self.clock = clock
+        self.rollover_at = clock() + interval
+
+    def shouldRollover(self, record):
+        """Rotate on age as well as on size."""
+        if self.interval and self.clock() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        """Rotate the file and plan the next time-based rotation."""
+        super().doRollover()
+        self.rollover_at = self.clock() + self.interval
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that keeps the traceback apart from the message."""
+
+    def prepare(self, record):
+        """Render the message and traceback without merging them.
+
+        The stock handler formats the whole record into msg, so the JSON
+        formatter behind the queue never sees the exception.
+        """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def configure_logging(path=LOG_FILE, level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Send log records through a queue to a background writer thread."""
+    formatter = JsonFormatter() if log_format == 'json' else (
+        logging.Formatter(LOG_TEXT_FORMAT)
     )
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(RotatingLogHandler(
+            path, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(records)
+    if LOG_SAMPLE_BURST:
+        queue_handler.addFilter(ErrorSampler())
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    return listener
 
-    main()
+
+def profile_startup():
+    """Log how long the deferred dependencies take to import."""
+    total = 0
+    for module in (requests, telegram):
+        started = time.perf_counter()
+        module.load()
+        seconds = time.perf_counter() - started
+        total += seconds
+        logging.info(STARTUP_IMPORT.format(name=module.name, seconds=seconds))
+    logging.info(STARTUP_IMPORT.format(name='total', seconds=total))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Homework status bot.')
+    parser.add_argument(
+        '--profile-startup', action='store_true',
+        help='log the import time of the deferred dependencies and exit'
+    )
+    options = parser.parse_args()
+    listener = configure_logging()
+    try:
+        if options.profile_startup:
+            profile_startup()
+        else:
+            main()
+    finally:
+        listener.stop()
@@ -0,0 +1,1573 @@
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch, homework_module):
+    for name, service in (('API_BREAKER', 'practicum'),
+                          ('TELEGRAM_BREAKER', 'telegram')):
+        monkeypatch.setattr(
+            homework_module, name, homework_module.CircuitBreaker(service)
+        )
+
+
+class FakeNotify:
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, message):
+        self.messages.append(message)
+
+
+class FakePracticumHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'{"homeworks": [], "current_date": 1}'
+    etag = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.etag and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_practicum():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakePracticumHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetch(*responses):
+    responses = list(responses)
+
+    def fetch(timestamp):
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return fetch
+
+
+class TestTenants:
+
+    def test_load_tenants_from_subscriptions(self, monkeypatch, tmp_path,
+                                             homework_module):
+        subscriptions = tmp_path / 'subscriptions.json'
+        subscriptions.write_text(json.dumps([
+            {'token': 'first', 'chat_id': 1},
+            {'token': 'second', 'chat_id': 2},
+        ]))
+        monkeypatch.setattr(
+            homework_module, 'SUBSCRIPTIONS_FILE', str(subscriptions)
+        )
+        tenants = homework_module.load_tenants(
+            bot=None, outbox=homework_module.Outbox()
+        )
+        assert [tenant.key for tenant in tenants] == [
+            homework_module.tenant_key('first', 1),
+            homework_module.tenant_key('second', 2),
+        ]
+        assert 'first' not in tenants[0].key
+
+    def test_poll_tenants_notifies_each_tenant(self, homework_module):
+        tenants = []
+        for name in ('hw1', 'hw2'):
+            tenants.append(homework_module.Tenant(
+                name,
+                make_fetch({
+                    'homeworks': [{'homework_name': name,
+                                   'status': 'approved'}],
+                    'current_date': 100
+                }),
+                FakeNotify()
+            ))
+        with homework_module.ThreadPoolExecutor(2) as executor:
+            homework_module.poll_tenants(tenants, executor)
+        for tenant in tenants:
+            assert len(tenant.notify.messages) == 1
+            assert tenant.key in tenant.notify.messages[0]
+            assert tenant.timestamp == 100
+
+    def test_poll_tenant_reports_error_once(self, homework_module):
+        tenant = homework_module.Tenant(
+            'hw', make_fetch(ValueError('boom')), FakeNotify()
+        )
+        homework_module.poll_tenant(tenant)
+        homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 1
+
+    def test_connections_are_reused(self, monkeypatch, fake_practicum,
+                                    homework_module):
+        session = homework_module.KeepAliveSession(1, 1, False)
+        monkeypatch.setattr(homework_module, 'HTTP_SESSION', session)
+        monkeypatch.setattr(homework_module, 'HTTP_KEEP_ALIVE', True)
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        for _ in range(3):
+            homework_module.get_api_answer(0)
+        assert session.stats() == {'new': 1, 'reused': 2}
+
+
+class TestStateStore:
+
+    @pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+    def test_restart_continues_from_saved_state(self, backend, tmp_path,
+                                                homework_module):
+        path = ':memory:' if backend == 'memory' else str(tmp_path / 'db')
+        store = homework_module.make_state_store(path)
+        response = {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 500
+        }
+        tenant = homework_module.Tenant('key', make_fetch(response),
+                                        FakeNotify())
+        homework_module.poll_tenant(tenant)
+        homework_module.save_tenants(store, [tenant])
+
+        if backend == 'sqlite':
+            store = homework_module.make_state_store(path)
+        timestamps = []
+
+        def fetch(timestamp):
+            timestamps.append(timestamp)
+            return response
+
+        restarted = homework_module.Tenant('key', fetch, FakeNotify())
+        restarted.restore(store.load('key'))
+        homework_module.poll_tenant(restarted)
+        assert timestamps == [500]
+        assert restarted.notify.messages == []
+
+
+class TestDiffHomeworks:
+
+    def test_every_transition_is_notified(self, homework_module):
+        first = {
+            'homeworks': [{'homework_name': 'hw1', 'status': 'reviewing'}],
+            'current_date': 10
+        }
+        second = {
+            'homeworks': [
+                {'homework_name': 'hw2', 'status': 'reviewing'},
+                {'homework_name': 'hw1', 'status': 'approved'},
+                {'homework_name': 'hw0', 'status': 'approved'},
+            ],
+            'current_date': 20
+        }
+        tenant = homework_module.Tenant(
+            'key', make_fetch(first, second, second), FakeNotify()
+        )
+        for _ in range(3):
+            homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 4
+        assert '"hw0"' in tenant.notify.messages[1]
+        assert '"hw1"' in tenant.notify.messages[2]
+        assert '"hw2"' in tenant.notify.messages[3]
+        assert tenant.timestamp == 20
+
+    def test_first_sync_sends_only_latest(self, homework_module):
+        response = {
+            'homeworks': [
+                {'homework_name': 'new', 'status': 'reviewing'},
+                {'homework_name': 'old', 'status': 'approved'},
+            ],
+            'current_date': 10
+        }
+        tenant = homework_module.Tenant('key', make_fetch(response),
+                                        FakeNotify())
+        homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 1
+        assert '"new"' in tenant.notify.messages[0]
+        assert tenant.statuses == {'new': 'reviewing', 'old': 'approved'}
+
+    def test_empty_index_after_sync_sends_every_change(self,
+                                                       homework_module):
+        response = {
+            'homeworks': [
+                {'homework_name': 'new', 'status': 'reviewing'},
+                {'homework_name': 'old', 'status': 'approved'},
+            ],
+            'current_date': 20
+        }
+        tenant = homework_module.Tenant('key', make_fetch(response),
+                                        FakeNotify())
+        tenant.restore(dict(
+            timestamp=10, statuses={'hw': 'approved'}, last_error=''
+        ))
+        homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 2
+
+    def test_window_moves_without_changes(self, homework_module):
+        response = {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 30
+        }
+        tenant = homework_module.Tenant('key', make_fetch(response),
+                                        FakeNotify())
+        tenant.statuses['hw'] = 'approved'
+        homework_module.poll_tenant(tenant)
+        assert tenant.notify.messages == []
+        assert tenant.timestamp == 30
+
+    def test_window_stays_on_empty_response(self, homework_module):
+        response = {'homeworks': [], 'current_date': 30}
+        tenant = homework_module.Tenant('key', make_fetch(response),
+                                        FakeNotify())
+        tenant.timestamp = 10
+        homework_module.poll_tenant(tenant)
+        assert tenant.timestamp == 10
+
+
+class TestHomeworkRecord:
+
+    def test_record_is_validated_once(self, homework_module):
+        record = homework_module.Homework.from_dict(
+            {'id': 7, 'homework_name': 'hw', 'status': 'rejected',
+             'reviewer_comment': 'Поправьте тесты'}
+        )
+        assert record.id == 7
+        assert record.status is homework_module.HomeworkStatus.REJECTED
+        assert record.message == homework_module.parse_status(
+            {'homework_name': 'hw', 'status': 'rejected'}
+        )
+        assert not hasattr(record, '__dict__')
+
+    @pytest.mark.parametrize('data, error', (
+        ({'status': 'approved'}, KeyError),
+        ({'homework_name': 'hw', 'status': 'unknown'}, ValueError),
+    ))
+    def test_invalid_homework(self, data, error, homework_module):
+        with pytest.raises(error):
+            homework_module.Homework.from_dict(data)
+
+    def test_index_holds_shared_statuses(self, homework_module):
+        tenant = homework_module.Tenant('key', None, None)
+        tenant.restore(dict(
+            timestamp=0, statuses={'hw1': 'approved', 'hw2': 'approved'},
+            last_error='', index=homework_module.STATUS_INDEX
+        ))
+        assert tenant.statuses['hw1'] is tenant.statuses['hw2']
+        assert json.loads(json.dumps(tenant.snapshot()))['statuses'] == {
+            'hw1': 'approved', 'hw2': 'approved'
+        }
+
+
+class TestMessageTemplates:
+
+    def test_templates_match_parse_status_format(self, homework_module):
+        record = homework_module.Homework.from_dict(
+            {'homework_name': 'hw', 'status': 'approved'}
+        )
+        assert record.message == homework_module.PARSE_STATUS_RESULT.format(
+            homework_name='hw',
+            verdict=homework_module.HOMEWORK_VERDICTS['approved']
+        )
+
+    def test_other_locale(self, homework_module):
+        templates = homework_module.MessageTemplates('en')
+        record = homework_module.Homework.from_dict(
+            {'homework_name': 'hw', 'status': 'reviewing'}
+        )
+        assert templates.render(record) == (
+            'The review status of "hw" has changed. '
+            'The work has been taken for review.'
+        )
+
+    def test_unknown_locale(self, homework_module):
+        with pytest.raises(ValueError):
+            homework_module.MessageTemplates('xx')
+
+    def test_dedupe_uses_homework_id(self, homework_module):
+        first = {
+            'homeworks': [
+                {'id': 1, 'homework_name': 'hw.zip', 'status': 'reviewing'}
+            ],
+            'current_date': 10
+        }
+        renamed = {
+            'homeworks': [
+                {'id': 1, 'homework_name': 'hw_v2.zip', 'status': 'reviewing'}
+            ],
+            'current_date': 20
+        }
+        tenant = homework_module.Tenant(
+            'key', make_fetch(first, renamed), FakeNotify()
+        )
+        homework_module.poll_tenant(tenant)
+        homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 1
+        assert tenant.statuses == {'1': 'reviewing'}
+
+    def test_name_keyed_state_is_dropped(self, homework_module):
+        tenant = homework_module.Tenant('key', None, None)
+        tenant.restore(dict(
+            timestamp=10, statuses={'hw.zip': 'approved'}, last_error=''
+        ))
+        assert tenant.timestamp == 10
+        assert tenant.statuses == {}
+
+
+class FakeClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRandom:
+    def random(self):
+        return 0.5
+
+
+class TestPollScheduler:
+
+    def make_policy(self, homework_module):
+        return homework_module.AdaptivePollPolicy(
+            base=600, minimum=60, maximum=2400, backoff=2, jitter=0.1,
+            rng=FakeRandom()
+        )
+
+    def test_adaptive_policy(self, homework_module):
+        policy = self.make_policy(homework_module)
+        tenant = homework_module.Tenant('key', None, None)
+        changed = homework_module.POLL_CHANGED
+        idle = homework_module.POLL_IDLE
+        error = homework_module.POLL_ERROR
+        assert policy.next_period(tenant, idle) == 1200
+        assert policy.next_period(tenant, idle) == 2400
+        assert policy.next_period(tenant, idle) == 2400
+        assert policy.next_period(tenant, changed) == 600
+        tenant.statuses['hw'] = 'reviewing'
+        assert policy.next_period(tenant, idle) == 60
+        assert policy.next_period(tenant, error) == 120
+
+    def test_scheduler_polls_only_due_tenants(self, homework_module):
+        clock = FakeClock()
+        scheduler = homework_module.PollScheduler(
+            self.make_policy(homework_module), clock
+        )
+        reviewing = homework_module.Tenant('reviewing', None, None)
+        reviewing.statuses['hw'] = 'reviewing'
+        idle = homework_module.Tenant('idle', None, None)
+        tenants = [reviewing, idle]
+        due = scheduler.due_tenants(tenants)
+        scheduler.record(due, [homework_module.POLL_IDLE] * 2)
+        assert scheduler.delay() == 60
+        clock.now = 60
+        assert scheduler.due_tenants(tenants) == [reviewing]
+        clock.now = 1200
+        assert scheduler.due_tenants(tenants) == tenants
+
+    def test_unknown_policy(self, homework_module):
+        with pytest.raises(ValueError):
+            homework_module.make_poll_policy('unknown')
+
+
+class FlakySend:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.texts = []
+
+    def __call__(self, text):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('telegram is down')
+        self.texts.append(text)
+
+
+class TestOutbox:
+
+    def make_outbox(self, homework_module, clock, **kwargs):
+        options = dict(size=10, global_rate=30, chat_rate=1, chat_burst=1,
+                       max_attempts=3, retry_delay=5, clock=clock)
+        options.update(kwargs)
+        return homework_module.Outbox(**options)
+
+    def test_pending_messages_are_coalesced(self, homework_module):
+        clock = FakeClock()
+        outbox = self.make_outbox(homework_module, clock)
+        send = FlakySend()
+        outbox.put(1, send, 'first')
+        outbox.put(1, send, 'second')
+        outbox.flush()
+        assert send.texts == ['first\n\nsecond']
+        assert outbox.pending == 0
+
+    def test_chat_rate_limit(self, homework_module):
+        clock = FakeClock()
+        outbox = self.make_outbox(homework_module, clock)
+        send = FlakySend()
+        outbox.put(1, send, 'first')
+        outbox.flush()
+        outbox.put(1, send, 'second')
+        outbox.flush()
+        assert send.texts == ['first']
+        assert outbox.next_delay() == 1
+        clock.now = 1
+        outbox.flush()
+        assert send.texts == ['first', 'second']
+
+    def test_failed_send_is_retried_with_backoff(self, homework_module,
+                                                 caplog):
+        clock = FakeClock()
+        outbox = self.make_outbox(homework_module, clock, chat_burst=10)
+        send = FlakySend(failures=1)
+        outbox.put(1, send, 'verdict')
+        outbox.flush()
+        assert send.texts == []
+        assert outbox.next_delay() == 5
+        clock.now = 5
+        outbox.flush()
+        assert send.texts == ['verdict']
+
+    def test_message_dropped_after_max_attempts(self, homework_module):
+        clock = FakeClock()
+        outbox = self.make_outbox(homework_module, clock, chat_burst=10)
+        send = FlakySend(failures=3)
+        outbox.put(1, send, 'verdict')
+        for now in (0, 5, 15, 35):
+            clock.now = now
+            outbox.flush()
+        assert send.texts == []
+        assert outbox.pending == 0
+
+    def test_queue_is_bounded(self, homework_module):
+        outbox = self.make_outbox(homework_module, FakeClock(), size=1)
+        outbox.put(1, FlakySend(), 'first')
+        with pytest.raises(homework_module.queue.Full):
+            outbox.put(2, FlakySend(), 'second')
+
+
+class TestMetrics:
+
+    def test_histogram_render(self, homework_module):
+        registry = homework_module.MetricsRegistry()
+        latency = registry.add('latency_seconds', 'Latency.', 'histogram',
+                               (0.1, 1))
+        latency.observe(0.05, code=200)
+        latency.observe(0.5, code=200)
+        lines = registry.render().splitlines()
+        assert 'latency_seconds_bucket{code="200",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{code="200",le="1"} 2' in lines
+        assert 'latency_seconds_bucket{code="200",le="+Inf"} 2' in lines
+        assert 'latency_seconds_count{code="200"} 2' in lines
+
+    def test_api_requests_are_instrumented(self, monkeypatch, fake_practicum,
+                                           homework_module):
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        before = homework_module.API_RESPONSES.values.get(
+            (('code', 200),), 0
+        )
+        homework_module.get_api_answer(0)
+        assert homework_module.API_RESPONSES.values[(('code', 200),)] == (
+            before + 1
+        )
+
+    def test_metrics_endpoint(self, homework_module):
+        server = homework_module.start_metrics_server('127.0.0.1', 0)
+        try:
+            response = homework_module.requests.get(
+                f'http://127.0.0.1:{server.server_port}/metrics'
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert response.status_code == 200
+        assert '# TYPE homework_api_request_seconds histogram' in (
+            response.text
+        )
+
+
+def make_stream(homework_module, data, chunk_size=1):
+    body = json.dumps(data, ensure_ascii=False).encode()
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    return homework_module.HomeworkStream(chunks, dict(
+        url='url', headers={}, params={'from_date': 0}
+    ))
+
+
+class TestHomeworkStream:
+
+    def test_stream_yields_homeworks_and_fields(self, homework_module):
+        data = {
+            'homeworks': [
+                {'homework_name': 'Проект', 'status': 'approved'},
+                {'homework_name': 'hw2', 'status': 'reviewing'},
+            ],
+            'current_date': 1234567890
+        }
+        stream = make_stream(homework_module, data)
+        assert list(stream.homeworks()) == data['homeworks']
+        assert stream.fields == {'current_date': 1234567890}
+
+    @pytest.mark.parametrize('data, error', [
+        ([{'homeworks': []}], TypeError),
+        ({'current_date': 1}, KeyError),
+        ({'homeworks': {'homework_name': 'hw'}}, TypeError),
+        ({'code': 'not_authenticated', 'homeworks': []}, ValueError),
+    ])
+    def test_stream_checks_structure(self, data, error, homework_module):
+        stream = make_stream(homework_module, data, chunk_size=7)
+        with pytest.raises(error):
+            list(stream.homeworks())
+
+    def test_diff_stream_stops_at_seen_homework(self, homework_module):
+        data = {
+            'homeworks': [
+                {'homework_name': 'new', 'status': 'reviewing'},
+                {'homework_name': 'old', 'status': 'approved'},
+                {'homework_name': 'older', 'status': 'unknown'},
+            ],
+            'current_date': 50
+        }
+        events, current_date = homework_module.diff_stream(
+            {'old': 'approved'}, make_stream(homework_module, data, 16)
+        )
+        assert [event[:2] for event in events] == [('new', 'reviewing')]
+        assert current_date == 50
+
+    def test_poll_tenant_with_streamed_response(self, monkeypatch,
+                                                fake_practicum,
+                                                homework_module):
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        tenant = homework_module.Tenant(
+            'key',
+            homework_module.partial(homework_module.stream_api_answer, {}),
+            FakeNotify()
+        )
+        assert homework_module.poll_tenant(tenant) == (
+            homework_module.POLL_IDLE
+        )
+        assert tenant.timestamp == 0
+
+
+class BodyResponse:
+    status_code = 200
+    headers = {}
+    content = b'{"homeworks": [], "current_date": 1}'
+
+    def __init__(self, decoded):
+        self.decoded = decoded
+
+    def json(self):
+        self.decoded.append('json')
+        return json.loads(self.content)
+
+
+class FullOnceNotify(FakeNotify):
+    def __init__(self):
+        super().__init__()
+        self.full = True
+
+    def __call__(self, message):
+        if self.full:
+            self.full = False
+            raise queue.Full
+        super().__call__(message)
+
+
+class TestResponseCache:
+
+    def poll_twice(self, monkeypatch, fake_practicum, homework_module):
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        cache = homework_module.ResponseCache()
+        fetch = homework_module.make_fetcher({'Authorization': 'OAuth t'},
+                                             cache)
+        first = fetch(0)
+        first.commit()
+        second = fetch(0)
+        return first.response, second
+
+    def test_unchanged_body_is_a_hit(self, monkeypatch, fake_practicum,
+                                     homework_module):
+        monkeypatch.setattr(FakePracticumHandler, 'requests', [])
+        first, second = self.poll_twice(
+            monkeypatch, fake_practicum, homework_module
+        )
+        assert first == {'homeworks': [], 'current_date': 1}
+        assert second is homework_module.NOT_MODIFIED
+
+    def test_etag_is_sent_back(self, monkeypatch, fake_practicum,
+                               homework_module):
+        monkeypatch.setattr(FakePracticumHandler, 'etag', '"v1"')
+        monkeypatch.setattr(FakePracticumHandler, 'requests', [])
+        _, second = self.poll_twice(
+            monkeypatch, fake_practicum, homework_module
+        )
+        assert second is homework_module.NOT_MODIFIED
+        assert FakePracticumHandler.requests[1]['If-None-Match'] == '"v1"'
+
+    def test_hit_skips_response_checks(self, monkeypatch, homework_module):
+        decoded = []
+        monkeypatch.setattr(
+            homework_module, 'http_get',
+            lambda **kwargs: BodyResponse(decoded)
+        )
+        monkeypatch.setattr(
+            homework_module, 'check_response', decoded.append
+        )
+        fetch = homework_module.make_fetcher(
+            {'Authorization': 'OAuth t'}, homework_module.ResponseCache()
+        )
+        fetch(0).commit()
+        assert len(decoded) == 2
+        assert fetch(0) is homework_module.NOT_MODIFIED
+        assert len(decoded) == 2
+
+    def test_subscriptions_of_one_token_keep_own_entries(
+            self, monkeypatch, fake_practicum, homework_module):
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        monkeypatch.setattr(FakePracticumHandler, 'body', json.dumps({
+            'homeworks': [{'id': 1, 'homework_name': 'hw',
+                           'status': 'reviewing'}],
+            'current_date': 100
+        }).encode())
+        cache = homework_module.ResponseCache()
+        clock = FakeClock()
+        flights = homework_module.SingleFlight(ttl=5, clock=clock)
+        headers = homework_module.make_headers('shared')
+        tenants = [
+            homework_module.Tenant(key, homework_module.make_fetcher(
+                headers, cache, flights, key
+            ), FakeNotify())
+            for key in ('a', 'b')
+        ]
+        tenants[0].timestamp = tenants[1].timestamp = 50
+        homework_module.poll_tenant(tenants[0])
+        clock.now = 60
+        assert homework_module.poll_tenant(tenants[1]) == (
+            homework_module.POLL_CHANGED
+        )
+        assert tenants[1].timestamp == 100
+        assert len(tenants[1].notify.messages) == 1
+
+    def test_failed_notification_is_retried(self, monkeypatch,
+                                            fake_practicum, homework_module):
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        monkeypatch.setattr(FakePracticumHandler, 'body', json.dumps({
+            'homeworks': [{'id': 1, 'homework_name': 'hw',
+                           'status': 'approved'}],
+            'current_date': 100
+        }).encode())
+        notify = FullOnceNotify()
+        tenant = homework_module.Tenant('key', homework_module.make_fetcher(
+            {'Authorization': 'OAuth t'}, homework_module.ResponseCache(),
+            key='key'
+        ), notify)
+        assert homework_module.poll_tenant(tenant) == (
+            homework_module.POLL_ERROR
+        )
+        assert homework_module.poll_tenant(tenant) == (
+            homework_module.POLL_CHANGED
+        )
+        assert notify.messages[-1] == homework_module.parse_status(
+            {'homework_name': 'hw', 'status': 'approved'}
+        )
+
+    def test_cache_is_bounded(self, homework_module):
+        cache = homework_module.ResponseCache(size=1)
+        cache.store('first', (None, None, 'a'))
+        cache.store('second', (None, None, 'b'))
+        assert list(cache.entries) == ['second']
+
+
+class TestWebhook:
+
+    def test_pushed_statuses_are_sent_right_away(self, homework_module):
+        outbox = homework_module.Outbox()
+        send = FlakySend()
+        tenant = homework_module.Tenant(
+            'key', None, homework_module.partial(outbox.put, 1, send),
+            homework_module.token_digest('secret')
+        )
+        shard = homework_module.Shard(homework_module.MemoryStateStore())
+        shard.select([tenant])
+        server = homework_module.start_webhook_server(
+            '127.0.0.1', 0, [tenant], outbox, shard
+        )
+        url = f'http://127.0.0.1:{server.server_port}/homeworks'
+        payload = {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 100
+        }
+        try:
+            unknown = homework_module.requests.post(
+                url, json=payload, headers={'Authorization': 'OAuth other'}
+            )
+            invalid = homework_module.requests.post(
+                url, json={'homeworks': {}},
+                headers={'Authorization': 'OAuth secret'}
+            )
+            pushed = homework_module.requests.post(
+                url, json=payload, headers={'Authorization': 'OAuth secret'}
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert unknown.status_code == 404
+        assert invalid.status_code == 400
+        assert pushed.status_code == 204
+        assert len(send.texts) == 1
+        assert '"hw"' in send.texts[0]
+        assert tenant.timestamp == 0
+
+
+    @pytest.mark.parametrize('length', ['-1', 'abc'])
+    def test_invalid_content_length_is_rejected(self, length,
+                                                homework_module):
+        import http.client
+        tenant = homework_module.Tenant(
+            'key', None, FakeNotify(), homework_module.token_digest('secret')
+        )
+        shard = homework_module.Shard(homework_module.MemoryStateStore())
+        shard.select([tenant])
+        server = homework_module.start_webhook_server(
+            '127.0.0.1', 0, [tenant], homework_module.Outbox(), shard
+        )
+        connection = http.client.HTTPConnection(
+            '127.0.0.1', server.server_port, timeout=2
+        )
+        try:
+            connection.putrequest('POST', '/homeworks')
+            connection.putheader('Authorization', 'OAuth secret')
+            connection.putheader('Content-Length', length)
+            connection.endheaders(b'{"homeworks": []}')
+            status = connection.getresponse().status
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+        assert status == 400
+
+
+class TestSharding:
+
+    def test_ring_moves_few_keys_when_a_worker_joins(self, homework_module):
+        keys = [f'tenant-{index}' for index in range(1000)]
+        before = homework_module.HashRing(['a', 'b', 'c'])
+        after = homework_module.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.owner(key) != after.owner(key)]
+        assert all(after.owner(key) == 'd' for key in moved)
+        assert 150 < len(moved) < 350
+
+    def test_tenants_are_split_and_rebalanced(self, tmp_path,
+                                              homework_module):
+        path = str(tmp_path / 'coordinator.sqlite3')
+        clock = FakeClock(1000)
+        first = homework_module.SqliteCoordinator(path, 'first', 90, clock)
+        second = homework_module.SqliteCoordinator(path, 'second', 90, clock)
+        first.heartbeat()
+        second.heartbeat()
+        store = homework_module.MemoryStateStore()
+        tenants = [
+            homework_module.Tenant(f'tenant-{index}', None, None)
+            for index in range(50)
+        ]
+        first_shard = homework_module.Shard(store, first)
+        second_shard = homework_module.Shard(store, second)
+        owned_by_first = first_shard.select(tenants)
+        owned_by_second = second_shard.select(tenants)
+        assert len(owned_by_first) + len(owned_by_second) == len(tenants)
+        assert not {tenant.key for tenant in owned_by_first} & {
+            tenant.key for tenant in owned_by_second
+        }
+
+        clock.now += 60
+        first.heartbeat()
+        clock.now += 60
+        assert first.members() == ['first']
+        assert len(first_shard.select(tenants)) == len(tenants)
+
+    def test_worker_with_lapsed_lease_owns_nothing(self, tmp_path, caplog,
+                                                   homework_module):
+        clock = FakeClock(1000)
+        coordinator = homework_module.SqliteCoordinator(
+            str(tmp_path / 'coordinator.sqlite3'), 'worker', 90, clock
+        )
+        coordinator.heartbeat()
+        clock.now += 120
+        assert coordinator.members() == []
+        assert homework_module.HashRing([]).owner('tenant') is None
+        shard = homework_module.Shard(
+            homework_module.MemoryStateStore(), coordinator
+        )
+        tenant = homework_module.Tenant('tenant', None, None)
+        assert shard.select([tenant]) == []
+        assert 'Аренда воркера worker истекла' in caplog.text
+        coordinator.heartbeat()
+        assert shard.select([tenant]) == [tenant]
+
+    def test_sleep_is_capped_by_the_heartbeat(self, tmp_path,
+                                              homework_module):
+        scheduler = homework_module.PollScheduler(
+            homework_module.FixedPollPolicy(600), FakeClock()
+        )
+        scheduler.due_tenants([])
+        coordinator = homework_module.SqliteCoordinator(
+            str(tmp_path / 'coordinator.sqlite3'), 'worker', 90, FakeClock()
+        )
+        assert homework_module.next_delay(scheduler) == 600
+        assert homework_module.next_delay(scheduler, coordinator) == 30
+
+    def test_acquired_tenant_restores_shared_state(self, homework_module):
+        store = homework_module.MemoryStateStore()
+        store.save_many([('key', dict(
+            timestamp=10, statuses={'hw': 'approved'}, last_error=''
+        ))])
+        tenant = homework_module.Tenant('key', None, None)
+        homework_module.Shard(store).select([tenant])
+        assert tenant.timestamp == 10
+
+    def test_scheduler_forgets_released_tenants(self, homework_module):
+        scheduler = homework_module.PollScheduler(
+            homework_module.FixedPollPolicy(600), FakeClock()
+        )
+        tenant = homework_module.Tenant('key', None, None)
+        scheduler.record([tenant], [homework_module.POLL_IDLE])
+        scheduler.due_tenants([])
+        assert scheduler.delay() == homework_module.RETRY_PERIOD
+
+
+class TestProcessPool:
+
+    def make_raw(self, homework_module, data):
+        return homework_module.RawResponse(
+            json.dumps(data).encode(), dict(url='url', headers={}, params={})
+        )
+
+    def test_decode_batch_returns_errors(self, homework_module):
+        results = homework_module.decode_batch([
+            self.make_raw(homework_module, {
+                'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+                'current_date': 5
+            }),
+            self.make_raw(homework_module, {'homeworks': {}}),
+        ])
+        assert results[0].current_date == 5
+        assert results[0].homeworks[0][:2] == ('hw', 'approved')
+        assert isinstance(results[1], TypeError)
+
+    def test_poll_tenants_in_processes(self, homework_module):
+        data = {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 5
+        }
+        tenants = [
+            homework_module.Tenant(
+                'ok', make_fetch(self.make_raw(homework_module, data)),
+                FakeNotify()
+            ),
+            homework_module.Tenant(
+                'down', make_fetch(ConnectionError('down')), FakeNotify()
+            ),
+        ]
+        with homework_module.ThreadPoolExecutor(2) as executor, \
+                homework_module.ProcessPoolExecutor(1) as process_pool:
+            outcomes = homework_module.run_cycle(
+                tenants, executor, process_pool
+            )
+        assert outcomes == [
+            homework_module.POLL_CHANGED, homework_module.POLL_ERROR
+        ]
+        assert '"hw"' in tenants[0].notify.messages[0]
+        assert tenants[0].timestamp == 5
+        assert 'down' in tenants[1].notify.messages[0]
+
+    def test_json_errors_are_counted_in_the_parent(self, homework_module):
+        errors = homework_module.API_JSON_ERRORS.values
+        before = errors.get((('key', 'error'),), 0)
+        tenant = homework_module.Tenant('key', make_fetch(self.make_raw(
+            homework_module, {'error': 'boom'}
+        )), FakeNotify())
+        with homework_module.ThreadPoolExecutor(1) as executor, \
+                homework_module.ProcessPoolExecutor(1) as process_pool:
+            assert homework_module.run_cycle(
+                [tenant], executor, process_pool
+            ) == [homework_module.POLL_ERROR]
+        assert errors[(('key', 'error'),)] == before + 1
+
+    def test_unsupported_options_are_logged(self, monkeypatch, caplog,
+                                            homework_module):
+        monkeypatch.setattr(homework_module, 'PROCESS_POOL_WORKERS', 2)
+        monkeypatch.setattr(homework_module, 'RESPONSE_CACHE', True)
+        homework_module.load_tenants(None, homework_module.Outbox())
+        assert 'выключены: RESPONSE_CACHE.' in caplog.text
+
+
+class TestStartup:
+
+    def test_heavy_modules_are_not_imported(self, homework_module):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(
+            [sys.executable, '-c',
+             'import sys, homework; '
+             'print(sorted({"telegram", "requests", "asyncio"} '
+             '& set(sys.modules)))'],
+            cwd=root, capture_output=True, text=True, check=True
+        ).stdout
+        assert output.strip() == '[]'
+
+    def test_lazy_module_imports_on_access(self, homework_module):
+        module = homework_module.LazyModule('textwrap')
+        assert module.module is None
+        assert module.dedent('  x') == 'x'
+        assert module.module is sys.modules['textwrap']
+
+    def test_bot_is_created_once_on_first_message(self, homework_module):
+        created = []
+
+        class Bot:
+            def __init__(self):
+                created.append(self)
+                self.messages = []
+
+            def send_message(self, chat_id, text):
+                self.messages.append((chat_id, text))
+
+        bot = homework_module.LazyBot(Bot)
+        assert created == []
+        bot.send_message(1, 'first')
+        bot.send_message(2, 'second')
+        assert len(created) == 1
+        assert created[0].messages == [(1, 'first'), (2, 'second')]
+
+
+def make_record(homework_module, message, level=None):
+    return homework_module.logging.LogRecord(
+        'root', level or homework_module.logging.ERROR, __file__, 1,
+        message, None, None
+    )
+
+
+class TestLogging:
+
+    def test_repeated_errors_are_sampled(self, homework_module):
+        clock = FakeClock()
+        sampler = homework_module.ErrorSampler(window=60, burst=2,
+                                               clock=clock)
+        passed = [
+            sampler.filter(make_record(homework_module, 'API down'))
+            for _ in range(5)
+        ]
+        assert passed == [True, True, False, False, False]
+        assert sampler.filter(make_record(homework_module, 'other'))
+        clock.now += 60
+        record = make_record(homework_module, 'API down')
+        assert sampler.filter(record)
+        assert record.suppressed == 3
+        assert '3' in record.getMessage()
+
+    def test_info_is_not_sampled(self, homework_module):
+        sampler = homework_module.ErrorSampler(burst=1, clock=FakeClock())
+        assert all(
+            sampler.filter(make_record(
+                homework_module, 'sent', homework_module.logging.INFO
+            ))
+            for _ in range(3)
+        )
+
+    def test_json_records(self, homework_module):
+        line = homework_module.JsonFormatter().format(
+            make_record(homework_module, 'Ошибка')
+        )
+        data = json.loads(line)
+        assert data['level'] == 'ERROR'
+        assert data['message'] == 'Ошибка'
+
+    def test_log_is_rotated_by_age(self, tmp_path, homework_module):
+        clock = FakeClock(1000)
+        path = tmp_path / 'bot.log'
+        handler = homework_module.RotatingLogHandler(
+            str(path), interval=60, backup_count=2, clock=clock
+        )
+        handler.emit(make_record(homework_module, 'first'))
+        clock.now += 60
+        handler.emit(make_record(homework_module, 'second'))
+        handler.close()
+        assert (tmp_path / 'bot.log.1').read_text().strip() == 'first'
+        assert path.read_text().strip() == 'second'
+
+    def test_records_are_written_in_background(self, tmp_path,
+                                               homework_module):
+        logging = homework_module.logging
+        path = tmp_path / 'bot.log'
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        listener = homework_module.configure_logging(
+            str(path), 'INFO', 'json'
+        )
+        try:
+            logging.info('queued')
+            logging.debug('skipped')
+        finally:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert [json.loads(line)['message'] for line in lines] == ['queued']
+
+    def test_exception_survives_the_queue(self, tmp_path, homework_module):
+        logging = homework_module.logging
+        path = tmp_path / 'bot.log'
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        listener = homework_module.configure_logging(
+            str(path), 'INFO', 'json'
+        )
+        try:
+            try:
+                raise ValueError('broken')
+            except ValueError:
+                logging.exception('failed')
+        finally:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+        data = json.loads(path.read_text(encoding='utf-8'))
+        assert data['message'] == 'failed'
+        assert 'ValueError: broken' in data['exception']
+
+
+class TestCircuitBreaker:
+
+    def make_breaker(self, homework_module, clock):
+        return homework_module.CircuitBreaker(
+            'practicum', threshold=2, recovery=30, clock=clock
+        )
+
+    def test_opens_after_threshold_and_fails_fast(self, homework_module):
+        clock = FakeClock()
+        breaker = self.make_breaker(homework_module, clock)
+        for _ in range(2):
+            breaker.before()
+            breaker.record(False)
+        assert breaker.state == breaker.OPEN
+        clock.now = 10
+        with pytest.raises(homework_module.CircuitOpenError) as error:
+            breaker.before()
+        assert error.value.retry_after == 20
+
+    def test_single_probe_closes_circuit(self, homework_module):
+        clock = FakeClock()
+        breaker = self.make_breaker(homework_module, clock)
+        breaker.record(False)
+        breaker.record(False)
+        clock.now = 30
+        breaker.before()
+        assert breaker.state == breaker.HALF_OPEN
+        with pytest.raises(homework_module.CircuitOpenError):
+            breaker.before()
+        breaker.record(True)
+        assert breaker.state == breaker.CLOSED
+        breaker.before()
+
+    def test_failed_probe_reopens_circuit(self, homework_module):
+        clock = FakeClock()
+        breaker = self.make_breaker(homework_module, clock)
+        breaker.record(False)
+        breaker.record(False)
+        clock.now = 30
+        breaker.before()
+        breaker.record(False)
+        assert breaker.state == breaker.OPEN
+        with pytest.raises(homework_module.CircuitOpenError):
+            breaker.before()
+
+    def test_outbox_defers_without_counting_attempts(self, homework_module):
+        clock = FakeClock()
+        outbox = homework_module.Outbox(max_attempts=1, clock=clock)
+        texts = []
+
+        def send(text):
+            if clock.now < 20:
+                raise homework_module.CircuitOpenError('telegram', 20)
+            texts.append(text)
+
+        outbox.put(1, send, 'verdict')
+        outbox.flush()
+        assert outbox.pending == 1
+        assert outbox.next_delay() == 20
+        clock.now = 20
+        outbox.flush()
+        assert texts == ['verdict']
+
+    def test_open_circuit_is_not_reported_to_chat(self, homework_module):
+        tenant = homework_module.Tenant(
+            'key',
+            make_fetch(homework_module.CircuitOpenError('practicum', 30)),
+            FakeNotify()
+        )
+        assert homework_module.poll_tenant(tenant) == (
+            homework_module.POLL_ERROR
+        )
+        assert tenant.notify.messages == []
+
+
+class StatusResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class TestErrorIndex:
+
+    def api_error(self, monkeypatch, homework_module, status_code, token):
+        monkeypatch.setattr(
+            homework_module, 'http_get',
+            lambda **kwargs: StatusResponse(status_code)
+        )
+        with pytest.raises(ValueError) as error:
+            homework_module.request_api_answer(
+                homework_module.make_headers(token), status_code
+            )
+        return error.value
+
+    def test_fingerprint_ignores_request_details(self, monkeypatch,
+                                                 homework_module):
+        fingerprint = homework_module.error_fingerprint
+        first = self.api_error(monkeypatch, homework_module, 500, 'a')
+        second = self.api_error(monkeypatch, homework_module, 500, 'b')
+        assert str(first) != str(second)
+        assert fingerprint(first) == fingerprint(second)
+        assert fingerprint(first) != fingerprint(ConnectionError(str(first)))
+
+    def test_status_codes_are_reported_separately(self, monkeypatch,
+                                                  homework_module):
+        errors = [
+            self.api_error(monkeypatch, homework_module, code, 'token')
+            for code in (500, 500, 401)
+        ]
+        tenant = homework_module.Tenant('key', make_fetch(*errors),
+                                        FakeNotify())
+        for _ in errors:
+            homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 2
+        assert '401' in tenant.notify.messages[1]
+
+    def test_lasting_error_is_summarized(self, homework_module):
+        clock = FakeClock()
+        index = homework_module.ErrorIndex(
+            size=4, ttl=600, summary_period=60, clock=clock
+        )
+        counts = []
+        for _ in range(4):
+            counts.append(index.note('api'))
+            clock.now += 30
+        assert counts == [1, 0, 3, 0]
+        clock.now += 600
+        assert index.note('api') == 1
+
+    def test_index_is_bounded(self, homework_module):
+        index = homework_module.ErrorIndex(size=2, clock=FakeClock())
+        for fingerprint in ('first', 'second', 'third'):
+            index.note(fingerprint)
+        assert list(index.entries) == ['second', 'third']
+
+    def test_varying_errors_are_reported_once(self, homework_module):
+        errors = [
+            homework_module.api_error(
+                ConnectionError, f'params = {{"from_date": {timestamp}}}',
+                'ReadTimeout'
+            )
+            for timestamp in range(5)
+        ]
+        tenant = homework_module.Tenant('key', make_fetch(*errors),
+                                        FakeNotify())
+        for _ in errors:
+            homework_module.poll_tenant(tenant)
+        assert len(tenant.notify.messages) == 1
+
+    def test_restored_error_is_not_repeated(self, homework_module):
+        error = ValueError('API is down')
+        tenant = homework_module.Tenant('key', make_fetch(error), FakeNotify())
+        tenant.restore(dict(
+            timestamp=0, statuses={},
+            last_error=homework_module.error_fingerprint(error)
+        ))
+        homework_module.poll_tenant(tenant)
+        assert tenant.notify.messages == []
+
+
+class TestGracefulShutdown:
+
+    def test_signal_wakes_the_sleeping_loop(self, homework_module):
+        import signal
+        shutdown = homework_module.GracefulShutdown(timeout=5)
+        shutdown.install()
+        try:
+            timer = threading.Timer(
+                0.1, os.kill, (os.getpid(), signal.SIGTERM)
+            )
+            timer.start()
+            started = time.monotonic()
+            with shutdown:
+                time.sleep(5)
+            assert time.monotonic() - started < 1
+            assert shutdown.requested
+            with pytest.raises(KeyboardInterrupt):
+                shutdown.handle(signal.SIGTERM, None)
+        finally:
+            shutdown.restore()
+        assert signal.getsignal(signal.SIGTERM) is not shutdown.handle
+
+    def test_signal_outside_sleep_only_sets_the_flag(self, homework_module):
+        import signal
+        shutdown = homework_module.GracefulShutdown(clock=FakeClock(100))
+        try:
+            shutdown.handle(signal.SIGINT, None)
+        finally:
+            shutdown.restore()
+        assert shutdown.requested
+        assert shutdown.deadline() == 100 + shutdown.timeout
+
+    def test_signal_cuts_a_slow_cycle_short(self, homework_module):
+        import signal
+        release = threading.Event()
+
+        def hung(timestamp):
+            release.wait(5)
+            return {'homeworks': [], 'current_date': 1}
+
+        tenants = [homework_module.Tenant('hung', hung, FakeNotify())]
+        shutdown = homework_module.GracefulShutdown(timeout=3)
+        shutdown.install()
+        executor = homework_module.ThreadPoolExecutor(1)
+        try:
+            threading.Timer(
+                0.1, os.kill, (os.getpid(), signal.SIGTERM)
+            ).start()
+            started = time.monotonic()
+            assert homework_module.poll_tenants(
+                tenants, executor, 300, shutdown.limit
+            ) == [homework_module.POLL_ERROR]
+            assert time.monotonic() - started < 2.5
+            assert time.monotonic() < shutdown.deadline() - 1
+        finally:
+            shutdown.restore()
+            release.set()
+            executor.shutdown()
+
+    def test_outbox_is_drained_until_deadline(self, homework_module,
+                                              monkeypatch, caplog):
+        clock = FakeClock()
+        monkeypatch.setattr(
+            homework_module.time, 'sleep',
+            lambda seconds: setattr(clock, 'now', clock.now + seconds)
+        )
+        outbox = homework_module.Outbox(chat_rate=1, chat_burst=1,
+                                        clock=clock)
+        send = FlakySend()
+        for message in ('first', 'second', 'third'):
+            outbox.put(1, send, message * 2000)
+        outbox.drain(deadline=1.5)
+        assert len(send.texts) == 2
+        assert outbox.pending == 1
+        assert 'не отправлено сообщений: 1' in caplog.text
+
+
+class TestFanOut:
+
+    def test_subscription_with_many_chats(self, monkeypatch, tmp_path,
+                                          homework_module):
+        subscriptions = tmp_path / 'subscriptions.json'
+        subscriptions.write_text(json.dumps([
+            {'token': 'cohort', 'chat_ids': [1, 2, 3]},
+        ]))
+        monkeypatch.setattr(
+            homework_module, 'SUBSCRIPTIONS_FILE', str(subscriptions)
+        )
+        outbox = homework_module.Outbox(workers=1)
+        tenants = homework_module.load_tenants(bot=None, outbox=outbox)
+        assert len(tenants) == 1
+        message = 'Изменился статус проверки работы'
+        tenants[0].notify(message)
+        assert sorted(outbox.chats) == [1, 2, 3]
+        assert all(
+            chat.messages[0] is message for chat in outbox.chats.values()
+        )
+
+    def test_errors_only_reach_the_owner(self, monkeypatch, tmp_path,
+                                         homework_module):
+        subscriptions = tmp_path / 'subscriptions.json'
+        subscriptions.write_text(json.dumps([
+            {'token': 'secret_tok', 'chat_ids': [1, 2, 3]},
+        ]))
+        monkeypatch.setattr(
+            homework_module, 'SUBSCRIPTIONS_FILE', str(subscriptions)
+        )
+        outbox = homework_module.Outbox(workers=1)
+        tenant, = homework_module.load_tenants(bot=None, outbox=outbox)
+        tenant.fetch = make_fetch(ValueError(
+            homework_module.GET_API_STATUS_CODE_EXCEPTIONS.format(
+                status_code=500, url=homework_module.ENDPOINT,
+                headers=homework_module.make_headers('secret_tok'),
+                params={'from_date': 0}
+            )
+        ))
+        homework_module.poll_tenant(tenant)
+        assert sorted(outbox.chats) == [1]
+        assert len(outbox.chats[1].messages) == 1
+        tenant.notify('verdict')
+        assert not any(
+            'secret_tok' in message
+            for chat_id in (2, 3)
+            for message in outbox.chats[chat_id].messages
+        )
+
+    def test_chats_are_delivered_in_parallel(self, homework_module):
+        barrier = threading.Barrier(3, timeout=1)
+        delivered = []
+
+        def send(text):
+            barrier.wait()
+            delivered.append(text)
+
+        outbox = homework_module.Outbox(workers=3)
+        homework_module.fan_out(
+            outbox, [(chat_id, send) for chat_id in range(3)], 'verdict'
+        )
+        outbox.flush()
+        assert delivered == ['verdict'] * 3
+        assert outbox.pending == 0
+
+
+class TestSingleFlight:
+
+    def test_concurrent_callers_share_one_request(self, homework_module):
+        flights = homework_module.SingleFlight(ttl=0)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch(timestamp):
+            calls.append(timestamp)
+            started.set()
+            release.wait(1)
+            return {'homeworks': [], 'current_date': timestamp}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                flights.fetch('token', fetch, 10)
+            ))
+            for _ in range(3)
+        ]
+        threads[0].start()
+        started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert calls == [10]
+        assert len(results) == 3
+        assert all(result is results[0] for result in results)
+        assert flights.calls == {}
+
+    def test_result_is_cached_briefly(self, homework_module):
+        clock = FakeClock()
+        flights = homework_module.SingleFlight(ttl=5, clock=clock)
+        fetch = make_fetch({'homeworks': []}, {'homeworks': [1]})
+        assert flights.fetch('token', fetch, 0) == {'homeworks': []}
+        assert flights.fetch('token', fetch, 0) == {'homeworks': []}
+        assert flights.fetch('other', fetch, 0) == {'homeworks': [1]}
+        clock.now = 5
+        assert flights.fetch('token', fetch, 0) == {'homeworks': [1]}
+
+    def test_error_is_shared_but_not_cached(self, homework_module):
+        flights = homework_module.SingleFlight(ttl=5, clock=FakeClock())
+        fetch = make_fetch(ConnectionError('down'), {'homeworks': []})
+        with pytest.raises(ConnectionError):
+            flights.fetch('token', fetch, 0)
+        assert flights.fetch('token', fetch, 0) == {'homeworks': []}
+
+    def test_subscriptions_of_one_token_poll_once(self, monkeypatch,
+                                                  tmp_path, fake_practicum,
+                                                  homework_module):
+        subscriptions = tmp_path / 'subscriptions.json'
+        subscriptions.write_text(json.dumps([
+            {'token': 'shared', 'chat_id': 1},
+            {'token': 'shared', 'chat_id': 2},
+        ]))
+        monkeypatch.setattr(
+            homework_module, 'SUBSCRIPTIONS_FILE', str(subscriptions)
+        )
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        monkeypatch.setattr(FakePracticumHandler, 'requests', [])
+        tenants = homework_module.load_tenants(
+            bot=None, outbox=homework_module.Outbox()
+        )
+        for tenant in tenants:
+            homework_module.poll_tenant(tenant)
+        assert len(FakePracticumHandler.requests) == 1
+
+
+class TestSimulation:
+
+    def load_simulation(self):
+        import importlib.util
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        spec = importlib.util.spec_from_file_location(
+            'simulate', os.path.join(root, 'benchmarks', 'simulate.py')
+        )
+        simulation = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(simulation)
+        return simulation
+
+    def run(self, simulation, **options):
+        defaults = dict(
+            tenants=20, tokens=0, days=1, homeworks=2, review=3600,
+            fix=3600, policy='fixed', period=600, response_cache=False,
+            single_flight=False, seed=7, per_tenant=False
+        )
+        defaults.update(options)
+        report = simulation.simulate(argparse.Namespace(**defaults))
+        report.pop('wall_seconds')
+        return report
+
+    def test_simulation_is_deterministic(self, homework_module):
+        simulation = self.load_simulation()
+        http_get = homework_module.http_get
+        first = self.run(simulation)
+        assert first == self.run(simulation)
+        assert homework_module.http_get is http_get
+        assert first['api_calls']['total'] == 20 * 144
+        assert first['detection_latency']['max'] < 600
+        assert 0 < first['sends']['total'] <= (
+            first['detection_latency']['count']
+        )
+
+    def test_single_flight_saves_calls(self, homework_module):
+        simulation = self.load_simulation()
+        report = self.run(simulation, tokens=5, single_flight=True)
+        assert report['api_calls']['total'] == 5 * 144
+
+
+class ClosableResponse:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestSlowUpstream:
+
+    def test_api_requests_have_timeouts(self, monkeypatch, fake_practicum,
+                                        homework_module):
+        calls = []
+        send_get = homework_module.send_get
+
+        def record(**kwargs):
+            calls.append(kwargs)
+            return send_get(**kwargs)
+
+        monkeypatch.setattr(homework_module, 'send_get', record)
+        monkeypatch.setattr(homework_module, 'ENDPOINT', fake_practicum)
+        homework_module.get_api_answer(0)
+        assert calls[0]['timeout'] == (
+            homework_module.API_CONNECT_TIMEOUT,
+            homework_module.API_READ_TIMEOUT
+        )
+
+    def test_hung_tenant_misses_the_cycle_deadline(self, homework_module):
+        release = threading.Event()
+        calls = []
+
+        def hung(timestamp):
+            calls.append(timestamp)
+            release.wait(5)
+            return {'homeworks': [], 'current_date': 1}
+
+        tenants = [
+            homework_module.Tenant('hung', hung, FakeNotify()),
+            homework_module.Tenant(
+                'fast', make_fetch({'homeworks': [], 'current_date': 1}),
+                FakeNotify()
+            )
+        ]
+        with homework_module.ThreadPoolExecutor(4) as executor:
+            started = time.monotonic()
+            outcomes = homework_module.poll_tenants(tenants, executor, 0.1)
+            assert time.monotonic() - started < 1
+            assert outcomes == [
+                homework_module.POLL_ERROR, homework_module.POLL_IDLE
+            ]
+            homework_module.poll_tenants(tenants, executor, 0.1)
+            assert len(calls) == 1
+            release.set()
+            tenants[0].polling.result(1)
+            assert homework_module.poll_tenants(tenants, executor, 1) == [
+                homework_module.POLL_IDLE, homework_module.POLL_IDLE
+            ]
+        assert len(calls) == 2
+
+    def test_slow_request_is_hedged(self, homework_module):
+        release = threading.Event()
+        responses = []
+
+        def get(**kwargs):
+            response = ClosableResponse(f'attempt {len(responses)}')
+            responses.append(response)
+            if len(responses) == 1:
+                release.wait(5)
+            return response
+
+        window = homework_module.LatencyWindow(minimum=1)
+        window.add(0.01)
+        hedged = homework_module.HedgedGet(get, workers=2, window=window)
+        started = time.monotonic()
+        assert hedged(url='url').name == 'attempt 1'
+        assert time.monotonic() - started < 1
+        release.set()
+        hedged.executor.shutdown(wait=True)
+        assert responses[0].closed
+        assert not responses[1].closed
+
+    def test_no_hedge_without_enough_samples(self, homework_module):
+        calls = []
+
+        def get(**kwargs):
+            calls.append(kwargs)
+            return ClosableResponse('only')
+
+        hedged = homework_module.HedgedGet(
+            get, window=homework_module.LatencyWindow(minimum=2)
+        )
+        assert hedged(url='url').name == 'only'
+        assert hedged(url='url').name == 'only'
+        assert len(calls) == 2
+        assert hedged.executor is None
+        assert hedged.window.quantile(0.95) is not None